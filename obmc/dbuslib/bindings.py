@@ -14,9 +14,14 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import contextlib
+import itertools
+import time
 import dbus
 import dbus.service
 import dbus.exceptions
+import gobject
+from obmc.utils.pathtree import PathTree
 
 OBJ_PREFIX = '/xyz/openbmc_project'
 
@@ -29,12 +34,44 @@ def get_dbus():
     return dbus.SystemBus()
 
 
+class _LazyProperty(object):
+    def __init__(self, getter, ttl, deferred):
+        self.getter = getter
+        self.ttl = ttl
+        self.deferred = deferred
+        self.expires = 0
+        self.waiters = None
+
+
 class DbusProperties(dbus.service.Object):
+    ''' A dbus.service.Object implementing org.freedesktop.DBus.Properties.
+
+    Keyword arguments:
+    validator -- Called with (interface, property, value) before a Set.
+    coalesce -- If not None, PropertiesChanged signals are merged per
+        interface and sent after this many milliseconds, or when the
+        main loop is next idle if 0.
+    urgent -- Property names whose changes are signalled immediately,
+        along with anything already pending on the same interface.
+    invalidates -- Property names whose changes are reported in
+        invalidated_properties rather than with their new values.
+    '''
+
     def __init__(self, **kw):
         self.validator = kw.pop('validator', None)
+        self.coalesce = kw.pop('coalesce', None)
+        self.urgent = frozenset(kw.pop('urgent', []))
+        self.invalidates = frozenset(kw.pop('invalidates', []))
         super(DbusProperties, self).__init__(**kw)
         self.properties = {}
+        self.getters = {}
         self._export = False
+        self._pending_changes = {}
+        self._flush_source = None
+        self._object_manager = None
+        self._managed_path = None
+        self.signals_emitted = 0
+        self.signals_coalesced = 0
 
     def unmask_signals(self):
         self._export = True
@@ -48,11 +85,132 @@ class DbusProperties(dbus.service.Object):
         if hasattr(inst, 'mask_signals'):
             inst.mask_signals()
 
-    @dbus.service.method(
-        dbus.PROPERTIES_IFACE,
-        in_signature='ss', out_signature='v')
-    def Get(self, interface_name, property_name):
-        d = self.GetAll(interface_name)
+    def add_getter(
+            self, interface_name, property_name, getter, ttl=0,
+            deferred=False):
+        ''' Compute a property on demand rather than storing it ahead
+        of time.
+
+        Get and GetAll call getter when the value was last read more
+        than ttl seconds ago, and changes it finds are signalled like
+        any other.
+
+        Arguments:
+        deferred -- If True, getter is called as getter(reply, error)
+            and completes by calling one of them, possibly from a later
+            main loop iteration.  D-Bus requests arriving while a read
+            is in flight wait for it instead of starting another.
+            Python callers of Get and GetAll get the last value read
+            and start a refresh if it is stale.
+        '''
+
+        self.getters.setdefault(interface_name, {})[property_name] = \
+            _LazyProperty(getter, ttl, deferred)
+
+    def remove_getter(self, interface_name, property_name):
+        getters = self.getters.get(interface_name, {})
+        getters.pop(property_name, None)
+        if not getters:
+            self.getters.pop(interface_name, None)
+
+    def _store(self, interface_name, property_name, value):
+        props = self.properties.setdefault(interface_name, {})
+        if property_name not in props or props[property_name] != value:
+            props[property_name] = value
+            self._properties_changed(interface_name, {property_name: value})
+
+    def _refresh(self, interface_name, property_name, lazy, waiter=None):
+        lazy.waiters = [waiter] if waiter else []
+
+        def reply(value):
+            lazy.expires = time.time() + lazy.ttl
+            waiters, lazy.waiters = lazy.waiters, None
+            self._store(interface_name, property_name, value)
+            for w in waiters:
+                w[0]()
+
+        def error(e):
+            waiters, lazy.waiters = lazy.waiters, None
+            for w in waiters:
+                w[1](e)
+
+        try:
+            lazy.getter(reply, error)
+        except Exception as e:
+            ## a getter that fails before it calls back fails the read,
+            ## rather than leaving its waiters in place for good
+            if lazy.waiters is not None:
+                error(e)
+            if waiter is None:
+                raise
+
+    def _read(self, interface_name, names, reply=None, error=None):
+        ''' Bring the lazy properties among names up to date.  Deferred
+        reads are only waited for, calling reply() or error(e) once
+        they finish, when reply is given.
+        '''
+
+        getters = self.getters.get(interface_name, {})
+        now = time.time()
+        pending = []
+        for name in names:
+            lazy = getters.get(name)
+            if lazy is None:
+                continue
+            if lazy.waiters is None and now < lazy.expires:
+                continue
+            if lazy.deferred:
+                pending.append((name, lazy))
+                continue
+            value = lazy.getter()
+            lazy.expires = now + lazy.ttl
+            self._store(interface_name, name, value)
+
+        if not reply:
+            for name, lazy in pending:
+                if lazy.waiters is None:
+                    self._refresh(interface_name, name, lazy)
+            return
+
+        if not pending:
+            reply()
+            return
+
+        remaining = [len(pending)]
+        failed = []
+
+        def done():
+            remaining[0] -= 1
+            if not remaining[0] and not failed:
+                reply()
+
+        def fail(e):
+            if not failed:
+                failed.append(e)
+                error(e)
+
+        for name, lazy in pending:
+            if lazy.waiters is not None:
+                lazy.waiters.append((done, fail))
+            else:
+                self._refresh(interface_name, name, lazy, (done, fail))
+
+    def _read_and_reply(self, interface_name, names, result, reply, error):
+        def done():
+            try:
+                value = result()
+            except Exception as e:
+                error(e)
+                return
+            reply(value)
+
+        try:
+            self._read(interface_name, names, done, error)
+        except Exception as e:
+            error(e)
+
+    def _get(self, interface_name, property_name):
+        d = self._get_all(interface_name)
         try:
             v = d[property_name]
             return v
@@ -60,10 +218,7 @@ class DbusProperties(dbus.service.Object):
             raise dbus.exceptions.DBusException(
                 "org.freedesktop.UnknownProperty: "+property_name)
 
-    @dbus.service.method(
-        dbus.PROPERTIES_IFACE,
-        in_signature='s', out_signature='a{sv}')
-    def GetAll(self, interface_name):
+    def _get_all(self, interface_name):
         try:
             d = self.properties[interface_name]
             return d
@@ -71,6 +226,35 @@ class DbusProperties(dbus.service.Object):
             raise dbus.exceptions.DBusException(
                 "org.freedesktop.UnknownInterface: "+interface_name)
 
+    @dbus.service.method(
+        dbus.PROPERTIES_IFACE,
+        in_signature='ss', out_signature='v',
+        async_callbacks=('reply', 'error'))
+    def Get(self, interface_name, property_name, reply=None, error=None):
+        if reply is None:
+            self._read(interface_name, [property_name])
+            return self._get(interface_name, property_name)
+
+        self._read_and_reply(
+            interface_name, [property_name],
+            lambda: self._get(interface_name, property_name),
+            reply, error)
+
+    @dbus.service.method(
+        dbus.PROPERTIES_IFACE,
+        in_signature='s', out_signature='a{sv}',
+        async_callbacks=('reply', 'error'))
+    def GetAll(self, interface_name, reply=None, error=None):
+        names = self.getters.get(interface_name, {}).keys()
+        if reply is None:
+            self._read(interface_name, names)
+            return self._get_all(interface_name)
+
+        self._read_and_reply(
+            interface_name, names,
+            lambda: self._get_all(interface_name),
+            reply, error)
+
     @dbus.service.method(
         dbus.PROPERTIES_IFACE,
         in_signature='ssv')
@@ -85,36 +269,97 @@ class DbusProperties(dbus.service.Object):
             old_value = self.properties[interface_name][property_name]
             if (old_value != new_value):
                 self.properties[interface_name][property_name] = new_value
-                if self._export:
-                    self.PropertiesChanged(
-                        interface_name, {property_name: new_value}, [])
+                self._properties_changed(
+                    interface_name, {property_name: new_value})
 
         except:
             self.properties[interface_name][property_name] = new_value
-            if self._export:
-                self.PropertiesChanged(
-                    interface_name, {property_name: new_value}, [])
+            self._properties_changed(
+                interface_name, {property_name: new_value})
 
     @dbus.service.method(
         "org.openbmc.Object.Properties", in_signature='sa{sv}')
     def SetMultiple(self, interface_name, prop_dict):
-        if (interface_name not in self.properties):
-            self.properties[interface_name] = {}
-
-        value_changed = False
-        for property_name in prop_dict:
-            new_value = prop_dict[property_name]
-            try:
-                old_value = self.properties[interface_name][property_name]
-                if (old_value != new_value):
-                    self.properties[interface_name][property_name] = new_value
-                    value_changed = True
-
-            except:
-                self.properties[interface_name][property_name] = new_value
-                value_changed = True
-        if (value_changed is True and self._export):
-            self.PropertiesChanged(interface_name, prop_dict, [])
+        if self.validator:
+            for property_name, new_value in prop_dict.iteritems():
+                self.validator(interface_name, property_name, new_value)
+
+        props = self.properties.setdefault(interface_name, {})
+        changed = dict(
+            (k, v) for k, v in prop_dict.iteritems()
+            if k not in props or props[k] != v)
+
+        if changed:
+            props.update(changed)
+            self._properties_changed(interface_name, changed)
+
+    def _properties_stored(self, interface_name):
+        ''' Note a change written straight to self.properties without a
+        PropertiesChanged signal, so the object manager's generation
+        still moves on.
+        '''
+
+        if self._object_manager is not None:
+            self._object_manager._object_changed(
+                self._managed_path, interface_name)
+
+    def _properties_changed(self, interface_name, changed):
+        self._properties_stored(interface_name)
+
+        if not self._export:
+            return
+
+        if self.coalesce is None or self.urgent.intersection(changed):
+            pending = self._pending_changes.pop(interface_name, None)
+            if pending:
+                pending[0].update(changed)
+                self.signals_coalesced += pending[1] + 1
+                changed = pending[0]
+            self._emit_properties_changed(interface_name, changed)
+            return
+
+        pending = self._pending_changes.setdefault(interface_name, [{}, -1])
+        pending[0].update(changed)
+        pending[1] += 1
+
+        if self._flush_source is None:
+            if self.coalesce:
+                self._flush_source = gobject.timeout_add(
+                    self.coalesce, self._flush_timeout)
+            else:
+                self._flush_source = gobject.idle_add(self._flush_timeout)
+
+    def _flush_timeout(self):
+        self._flush_source = None
+        self.flush()
+        return False
+
+    def flush(self):
+        ''' Send any PropertiesChanged signals held back by coalescing. '''
+
+        if self._flush_source is not None:
+            gobject.source_remove(self._flush_source)
+            self._flush_source = None
+
+        pending = self._pending_changes
+        self._pending_changes = {}
+        if not self._export:
+            return
+
+        for interface_name, (changed, coalesced) in pending.iteritems():
+            self.signals_coalesced += coalesced
+            self._emit_properties_changed(interface_name, changed)
+
+    def _emit_properties_changed(self, interface_name, changed):
+        invalidated = []
+        if self.invalidates:
+            invalidated = [k for k in changed if k in self.invalidates]
+            changed = dict(
+                (k, v) for k, v in changed.iteritems()
+                if k not in self.invalidates)
+
+        self.signals_emitted += 1
+        self.PropertiesChanged(interface_name, changed, invalidated)
 
     @dbus.service.signal(
         dbus.PROPERTIES_IFACE, signature='sa{sv}as')
@@ -159,10 +404,30 @@ def add_interfaces(ifaces):
 
 
 class DbusObjectManager(dbus.service.Object):
+    ''' A dbus.service.Object implementing org.freedesktop.DBus.ObjectManager.
+
+    The GetManagedObjects reply is kept up to date by add and remove
+    and shared between calls.  generation is bumped whenever an object
+    is added or removed, or a managed DbusProperties object changes a
+    property, whether signalled or stored silently with
+    _properties_stored.
+
+    Inside a transaction(), InterfacesAdded and InterfacesRemoved are
+    held back and sent when the outermost transaction ends: removals
+    deepest path first, then additions parent first.  An object added
+    and removed again within a transaction is not signalled.
+    '''
+
     def __init__(self, **kw):
         super(DbusObjectManager, self).__init__(**kw)
         self.objects = {}
+        self.managed_objects = {}
+        self.object_tree = PathTree(index=lambda props: props.keys())
+        self.generation = 0
         self._export = False
+        self._transactions = 0
+        self._pending_added = {}
+        self._pending_removed = {}
 
     def unmask_signals(self):
         self._export = True
@@ -176,28 +441,189 @@ class DbusObjectManager(dbus.service.Object):
         if hasattr(inst, 'mask_signals'):
             inst.mask_signals()
 
-    def add(self, object_path, obj):
+    def _add(self, object_path, obj):
         self.objects[object_path] = obj
-        if self._export:
+        self.managed_objects[object_path] = obj.properties
+        self.generation += 1
+        if isinstance(obj, DbusProperties):
+            obj._object_manager = self
+            obj._managed_path = object_path
+        if not self._export:
+            return
+
+        if self._transactions:
+            self._pending_added[object_path] = obj
+        else:
             self.InterfacesAdded(object_path, obj.properties)
 
+    def add(self, object_path, obj):
+        self._add(object_path, obj)
+        self.object_tree[object_path] = obj.properties
+
+    def add_many(self, objects):
+        ''' Add every (path, object) in objects, which may be a dict or
+        an iterable of pairs, signalling them as one transaction.
+        '''
+
+        if hasattr(objects, 'iteritems'):
+            objects = objects.iteritems()
+
+        with self.transaction():
+            added = []
+            for object_path, obj in objects:
+                self._add(object_path, obj)
+                added.append((object_path, obj.properties))
+            self.object_tree.update(added)
+
     def remove(self, object_path):
         obj = self.objects.pop(object_path, None)
+        if obj is None:
+            return
+
+        self.managed_objects.pop(object_path, None)
+        self._remove_from_tree(object_path)
+        self.generation += 1
+        if isinstance(obj, DbusProperties):
+            obj._object_manager = None
+            obj._managed_path = None
         obj.remove_from_connection()
-        if self._export:
+        if not self._export:
+            return
+
+        if not self._transactions:
             self.InterfacesRemoved(object_path, obj.properties.keys())
+        elif self._pending_added.pop(object_path, None) is None:
+            self._pending_removed[object_path] = obj.properties.keys()
+
+    def remove_many(self, object_paths):
+        with self.transaction():
+            for object_path in object_paths:
+                self.remove(object_path)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self._transactions += 1
+        try:
+            yield self
+        finally:
+            self._transactions -= 1
+            if not self._transactions:
+                self._flush_interfaces_signals()
+
+    def _flush_interfaces_signals(self):
+        removed = self._pending_removed
+        added = self._pending_added
+        self._pending_removed = {}
+        self._pending_added = {}
+
+        for object_path in sorted(removed, reverse=True):
+            self.InterfacesRemoved(object_path, removed[object_path])
+        for object_path in sorted(added):
+            self.InterfacesAdded(object_path, added[object_path].properties)
 
     def get(self, object_path, default=None):
         return self.objects.get(object_path, default)
 
+    def _remove_from_tree(self, object_path):
+        if object_path not in self.object_tree:
+            return
+        if self.object_tree.get_children(object_path):
+            self.object_tree.demote(object_path)
+        else:
+            self.object_tree.prune(object_path)
+
+    def _object_changed(self, object_path, interface_name):
+        self.generation += 1
+        indexed = self.object_tree.indexed.get(interface_name, ())
+        if object_path not in indexed:
+            self.object_tree[object_path] = self.managed_objects[object_path]
+
+    def _iter_filtered(self, path, interface, cursor=''):
+        ''' Iterate over the paths at or below path, implementing
+        interface if it is not empty, in path order and after cursor.
+        '''
+
+        tree = self.object_tree
+        subtree = path.rstrip('/') or '/'
+        if interface:
+            indexed = tree.indexed.get(interface, ())
+            try:
+                size = tree.count(subtree)
+            except KeyError:
+                return
+
+            if len(indexed) <= size:
+                prefix = subtree.rstrip('/') + '/'
+                for p in sorted(
+                        p for p in indexed
+                        if (p == subtree or p.startswith(prefix)) and
+                        p > cursor):
+                    yield p
+                return
+
+        if subtree > cursor and subtree in tree and (
+                not interface or interface in tree[subtree]):
+            yield subtree
+        try:
+            for p, props in tree.itersorted(subtree, cursor or None):
+                if not interface or interface in props:
+                    yield p
+        except KeyError:
+            return
+
     @dbus.service.method(
         "org.freedesktop.DBus.ObjectManager",
         in_signature='', out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
+        return self.managed_objects
+
+    @dbus.service.method(
+        "org.openbmc.Object.Enumerate",
+        in_signature='', out_signature='t')
+    def GetGeneration(self):
+        return self.generation
+
+    @dbus.service.method(
+        "org.openbmc.Object.Enumerate",
+        in_signature='t', out_signature='ta{oa{sa{sv}}}')
+    def GetManagedObjectsSince(self, generation):
+        if generation == self.generation:
+            return self.generation, {}
+        return self.generation, self.managed_objects
+
+    @dbus.service.method(
+        "org.openbmc.Object.Enumerate",
+        in_signature='ssst', out_signature='a{oa{sa{sv}}}s')
+    def GetManagedObjectsFiltered(self, path, interface, cursor, limit):
+        ''' Return the managed objects at or below path, in path order.
+
+        If interface is not empty only objects implementing it are
+        returned, with only that interface's properties.  At most
+        limit objects are returned if limit is not zero, starting
+        after the path given as cursor.  The second value is the
+        cursor for the next page, or empty if there are no more.
+        '''
+
+        ## paths come in order, so a page stops after one extra path
+        paths = self._iter_filtered(path, interface, cursor)
+        if limit:
+            paths = list(itertools.islice(paths, limit + 1))
+        else:
+            paths = list(paths)
+
+        next_cursor = ''
+        if limit and len(paths) > limit:
+            paths = paths[:limit]
+            next_cursor = paths[-1]
+
         data = {}
-        for objpath in self.objects.keys():
-            data[objpath] = self.objects[objpath].properties
-        return data
+        for p in paths:
+            props = self.managed_objects[p]
+            if interface:
+                props = {interface: props[interface]}
+            data[p] = props
+
+        return data, next_cursor
 
     @dbus.service.signal(
         "org.freedesktop.DBus.ObjectManager", signature='oa{sa{sv}}')
@@ -14,8 +14,12 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import collections
 import xml.etree.ElementTree as ET
+import xml.parsers.expat as expat
 import dbus
+import gobject
+from obmc.dbuslib.enums import DBUS_OBJMGR_IFACE
 
 
 class IntrospectionNodeParser:
@@ -68,13 +72,35 @@ class IntrospectionNodeParser:
                     continue
                 self.cache['interfaces'][name] = p.parse_interface()
             elif node.tag == 'node':
-                self.cache['children'] = self.parse_children()
+                self.cache['children'].append(node.attrib['name'])
 
         return self.cache
 
     def get_interfaces(self):
         return self.parse_node()['interfaces']
 
+    def get_interface_names(self):
+        if self.cache:
+            return self.cache['interfaces'].keys()
+
+        return [x.attrib['name'] for x in self.data.findall('interface')
+                if self.intf_match(x.attrib['name'])]
+
+    def get_interface(self, name):
+        if self.cache:
+            return self.cache['interfaces'].get(name)
+
+        for node in self.data.findall('interface'):
+            if node.attrib['name'] != name:
+                continue
+            if not self.intf_match(name):
+                break
+            p = IntrospectionNodeParser(
+                node, self.tag_match, self.intf_match)
+            return p.parse_interface()
+
+        return None
+
     def get_children(self):
         return self.parse_node()['children']
 
@@ -82,29 +108,246 @@ class IntrospectionNodeParser:
         return any('/' in s for s in self.get_children())
 
 
+class LazyIntrospectionNodeParser(IntrospectionNodeParser):
+    ''' An IntrospectionNodeParser that takes the raw introspection
+    XML and defers building an element tree until interface
+    members are requested.
+
+    Interface names and children are found with a single expat pass
+    over the top level elements, which is all a crawl needs.
+    '''
+
+    def __init__(self, xml, tag_match=bool, intf_match=bool):
+        IntrospectionNodeParser.__init__(self, None, tag_match, intf_match)
+        self.xml = xml
+        self.names = None
+
+    def _scan(self):
+        if self.names is not None:
+            return self.names
+
+        interfaces = []
+        children = []
+        depth = [0]
+
+        def start(tag, attrs):
+            depth[0] += 1
+            if depth[0] != 2:
+                return
+            if tag == 'interface':
+                interfaces.append(attrs['name'])
+            elif tag == 'node':
+                children.append(attrs['name'])
+
+        def end(tag):
+            depth[0] -= 1
+
+        p = expat.ParserCreate()
+        p.StartElementHandler = start
+        p.EndElementHandler = end
+        p.Parse(self.xml, True)
+
+        self.names = (interfaces, children)
+        return self.names
+
+    def rebind(self, tag_match=bool, intf_match=bool):
+        p = LazyIntrospectionNodeParser(self.xml, tag_match, intf_match)
+        p.names = self.names
+        p.data = self.data
+        return p
+
+    def parse_node(self):
+        if self.data is None:
+            self.data = ET.fromstring(self.xml)
+
+        return IntrospectionNodeParser.parse_node(self)
+
+    def get_interface_names(self):
+        if self.cache:
+            return self.cache['interfaces'].keys()
+
+        return filter(self.intf_match, self._scan()[0])
+
+    def get_interface(self, name):
+        if self.data is None:
+            self.data = ET.fromstring(self.xml)
+
+        return IntrospectionNodeParser.get_interface(self, name)
+
+    def get_children(self):
+        return list(self._scan()[1])
+
+
+class IntrospectionCache(object):
+    ''' An LRU cache of parsed introspection data, keyed by
+    (unique bus name, path).
+
+    Entries for a connection are dropped when NameOwnerChanged reports
+    it went away, and entries for an object and its ancestors are
+    dropped when the connection emits InterfacesAdded or
+    InterfacesRemoved for that object.  A single instance can be
+    shared by any number of IntrospectionParsers on the same bus.
+    '''
+
+    def __init__(self, bus, max_size=4096):
+        self.bus = bus
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.owner_paths = {}
+        self.owners = {}
+        self.hits = 0
+        self.misses = 0
+
+        bus.add_signal_receiver(
+            self._name_owner_changed,
+            dbus_interface=dbus.BUS_DAEMON_IFACE,
+            signal_name='NameOwnerChanged')
+        for signal in ['InterfacesAdded', 'InterfacesRemoved']:
+            bus.add_signal_receiver(
+                self._interfaces_changed,
+                dbus_interface=DBUS_OBJMGR_IFACE,
+                signal_name=signal,
+                sender_keyword='sender')
+
+    def _get_owner(self, name):
+        if name[0] == ':':
+            return name
+        owner = self.owners.get(name)
+        if owner is None:
+            try:
+                owner = str(self.bus.get_name_owner(name))
+            except dbus.DBusException:
+                return None
+            self.owners[name] = owner
+        return owner
+
+    def _drop(self, key):
+        self.entries.pop(key, None)
+        paths = self.owner_paths.get(key[0])
+        if paths is not None:
+            paths.discard(key[1])
+            if not paths:
+                del self.owner_paths[key[0]]
+
+    def _name_owner_changed(self, name, old, new):
+        if new and name[0] != ':':
+            self.owners[str(name)] = str(new)
+        else:
+            self.owners.pop(name, None)
+
+        if old:
+            self.invalidate(old)
+
+    def _interfaces_changed(self, path, *a, **kw):
+        sender = kw.get('sender')
+        if not sender:
+            return
+
+        elements = filter(bool, path.split('/'))
+        self.invalidate(sender, '/')
+        for i in range(len(elements)):
+            self.invalidate(sender, '/' + '/'.join(elements[:i + 1]))
+
+    def invalidate(self, name, path=None):
+        owner = self._get_owner(name)
+        if owner is None:
+            return
+
+        if path is not None:
+            self._drop((owner, path))
+            return
+
+        for p in list(self.owner_paths.get(owner, [])):
+            self._drop((owner, p))
+
+    def clear(self):
+        self.entries.clear()
+        self.owner_paths.clear()
+
+    def get(self, name, path):
+        owner = self._get_owner(name)
+        try:
+            value = self.entries.pop((owner, path))
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.entries[(owner, path)] = value
+        self.hits += 1
+        return value
+
+    def put(self, name, path, value):
+        owner = self._get_owner(name)
+        if owner is None:
+            return
+
+        key = (owner, path)
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        self.owner_paths.setdefault(owner, set()).add(path)
+
+        while len(self.entries) > self.max_size:
+            self._drop(next(iter(self.entries)))
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
 class IntrospectionParser:
-    def __init__(self, name, bus, tag_match=bool, intf_match=bool):
+    def __init__(
+            self, name, bus, tag_match=bool, intf_match=bool,
+            max_pending=None, cache=None):
         self.name = name
         self.bus = bus
         self.tag_match = tag_match
         self.intf_match = intf_match
+        self.max_pending = max_pending
+        self.cache = cache
+        self.errors = {}
+
+    def _make_parser(self, data, path=None):
+        parser = LazyIntrospectionNodeParser(
+            data,
+            self.tag_match,
+            self.intf_match)
+        parser.get_children()
+        if self.cache is not None and path is not None:
+            self.cache.put(self.name, path, parser)
+
+        return parser
+
+    def _cached(self, path):
+        if self.cache is None:
+            return None
+
+        parser = self.cache.get(self.name, path)
+        if parser is None:
+            return None
+
+        return parser.rebind(self.tag_match, self.intf_match)
 
     def _introspect(self, path):
+        parser = self._cached(path)
+        if parser:
+            return parser
+
         try:
             obj = self.bus.get_object(self.name, path, introspect=False)
             iface = dbus.Interface(obj, dbus.INTROSPECTABLE_IFACE)
             data = iface.Introspect()
-        except dbus.DBusException:
+            return self._make_parser(data, path)
+        except (dbus.DBusException, expat.ExpatError) as e:
+            self.errors[path] = e
             return None
 
-        return IntrospectionNodeParser(
-            ET.fromstring(data),
-            self.tag_match,
-            self.intf_match)
-
     def _discover_flat(self, path, parser):
         items = {}
-        interfaces = parser.get_interfaces().keys()
+        interfaces = parser.get_interface_names()
         if interfaces:
             items[path] = {}
             items[path]['interfaces'] = interfaces
@@ -112,6 +355,13 @@ class IntrospectionParser:
         return items
 
     def introspect(self, path='/', parser=None):
+        ## recursive calls pass a parser; only a new crawl clears the
+        ## errors of the last one
+        if not parser:
+            self.errors = {}
+        if self.max_pending and not parser:
+            return self.introspect_concurrent(path, self.max_pending)
+
         items = {}
         if not parser:
             parser = self._introspect(path)
@@ -134,3 +384,71 @@ class IntrospectionParser:
             items.update(callback(path + k, parser))
 
         return items
+
+    def introspect_concurrent(self, path='/', max_pending=16):
+        ''' Crawl the object tree rooted at path, keeping up to
+        max_pending asynchronous Introspect calls in flight.
+
+        Returns the same items dict as introspect().  Paths that
+        could not be introspected in this crawl are recorded in
+        self.errors.  The bus connection must be attached to the default
+        GLib main context, which is iterated until the crawl completes.
+        That dispatches every other source on the context, so this must
+        not be called from inside a GLib callback; crawl from there
+        with an IntrospectionParser without max_pending instead.
+        '''
+
+        self.errors = {}
+        items = {}
+        queue = collections.deque([(path, True)])
+        pending = set()
+        context = gobject.main_context_default()
+
+        def reply(path, recurse, data):
+            pending.discard(path)
+            try:
+                parser = self._make_parser(data, path)
+            except expat.ExpatError as e:
+                self.errors[path] = e
+                return
+
+            discover(path, recurse, parser)
+
+        def discover(path, recurse, parser):
+            items.update(self._discover_flat(path, parser))
+            if not recurse:
+                return
+
+            prefix = path if path == '/' else path + '/'
+            recurse = not parser.recursive_binding()
+            queue.extend((prefix + k, recurse)
+                         for k in parser.get_children())
+
+        def error(path, e):
+            pending.discard(path)
+            self.errors[path] = e
+
+        while queue or pending:
+            while queue and len(pending) < max_pending:
+                p, recurse = queue.popleft()
+                parser = self._cached(p)
+                if parser:
+                    discover(p, recurse, parser)
+                    continue
+                try:
+                    obj = self.bus.get_object(
+                        self.name, p, introspect=False)
+                    obj.Introspect(
+                        dbus_interface=dbus.INTROSPECTABLE_IFACE,
+                        reply_handler=lambda x, p=p, r=recurse:
+                            reply(p, r, x),
+                        error_handler=lambda e, p=p: error(p, e))
+                except dbus.DBusException as e:
+                    self.errors[p] = e
+                    continue
+                pending.add(p)
+
+            if pending:
+                context.iteration(True)
+
+        return items
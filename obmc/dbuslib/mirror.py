@@ -0,0 +1,259 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import dbus
+import gobject
+from obmc.dbuslib.enums import DBUS_OBJMGR_IFACE
+from obmc.dbuslib.introspection import IntrospectionParser
+from obmc.dbuslib.signals import get_dispatcher
+from obmc.utils.pathtree import PathTree
+
+
+class ObjectMirror(object):
+    ''' A local copy of the objects, interfaces and properties a
+    service exports at or below path.
+
+    The mirror is seeded from the service's GetManagedObjects, or by
+    crawling it with an IntrospectionParser and calling GetAll when it
+    has no ObjectManager, and is kept current from InterfacesAdded,
+    InterfacesRemoved and PropertiesChanged.  When the service drops
+    off the bus the mirror empties, and it is seeded again when the
+    name is next owned.  Reads are lookups in a PathTree of
+    {path: {interface: {property: value}}}.
+
+    Signals are only processed while the bus connection is attached
+    to a running main loop.  Only signals from the current owner of
+    name are subscribed to, and when the name is owned again the
+    mirror is seeded from an idle callback rather than from inside the
+    signal handler.
+    '''
+
+    def __init__(self, bus, name, path='/', intf_match=bool):
+        self.bus = bus
+        self.name = name
+        self.path = path.rstrip('/') or '/'
+        self.intf_match = intf_match
+        self.tree = PathTree(index=lambda ifaces: ifaces.keys())
+        self.owner = None
+        self.errors = {}
+        self._resync_source = None
+        self.dispatcher = get_dispatcher(bus)
+        ## ObjectManager signals come from the manager's path, which
+        ## may be above ours, so they are filtered on their object path
+        ## argument instead of by path namespace
+        self.signals = [
+            (self._interfaces_added, 'InterfacesAdded',
+                DBUS_OBJMGR_IFACE, None),
+            (self._interfaces_removed, 'InterfacesRemoved',
+                DBUS_OBJMGR_IFACE, None),
+            (self._properties_changed, 'PropertiesChanged',
+                dbus.PROPERTIES_IFACE, self.path),
+        ]
+
+        self.dispatcher.add(
+            self._name_owner_changed, 'NameOwnerChanged',
+            dbus.BUS_DAEMON_IFACE, sender=dbus.BUS_DAEMON_NAME, arg0=name)
+
+        try:
+            owner = str(bus.get_name_owner(name))
+        except dbus.DBusException:
+            return
+
+        ## subscribe before seeding so no change is missed between
+        ## the two
+        self._follow(owner)
+        self.resync()
+
+    def close(self):
+        self._follow(None)
+        self.dispatcher.remove(
+            self._name_owner_changed, 'NameOwnerChanged',
+            dbus.BUS_DAEMON_IFACE, sender=dbus.BUS_DAEMON_NAME,
+            arg0=self.name)
+        if self._resync_source is not None:
+            gobject.source_remove(self._resync_source)
+            self._resync_source = None
+
+    def _follow(self, owner):
+        ''' Move the signal subscriptions from the current owner to
+        owner, the unique name now owning the service, or None.
+        '''
+
+        if self.owner is not None:
+            for callback, member, interface, namespace in self.signals:
+                self.dispatcher.remove(
+                    callback, member, interface, namespace,
+                    sender=self.owner)
+
+        self.owner = owner
+        if owner is not None:
+            for callback, member, interface, namespace in self.signals:
+                self.dispatcher.add(
+                    callback, member, interface, namespace,
+                    path_keyword='signal_path', sender=owner)
+
+    def _in_subtree(self, path):
+        return self.path == '/' or path == self.path or \
+            path.startswith(self.path + '/')
+
+    def _filter_interfaces(self, interfaces):
+        return dict(
+            (str(k), dict(v)) for k, v in interfaces.iteritems()
+            if self.intf_match(k))
+
+    def _get_managed_objects(self):
+        obj = self.bus.get_object(self.name, self.path, introspect=False)
+        objects = obj.GetManagedObjects(dbus_interface=DBUS_OBJMGR_IFACE)
+        return dict(
+            (str(k), self._filter_interfaces(v))
+            for k, v in objects.iteritems() if self._in_subtree(k))
+
+    def _crawl(self):
+        parser = IntrospectionParser(
+            self.name, self.bus, intf_match=self.intf_match)
+        objects = {}
+        for path, item in parser.introspect(self.path).iteritems():
+            obj = self.bus.get_object(self.name, path, introspect=False)
+            interfaces = {}
+            for interface in item['interfaces']:
+                try:
+                    interfaces[str(interface)] = dict(obj.GetAll(
+                        interface, dbus_interface=dbus.PROPERTIES_IFACE))
+                except dbus.DBusException:
+                    interfaces[str(interface)] = {}
+            objects[str(path)] = interfaces
+        self.errors.update(parser.errors)
+
+        return objects
+
+    def resync(self):
+        ''' Discard the mirror and seed it again from the service. '''
+
+        self.errors = {}
+        try:
+            objects = self._get_managed_objects()
+        except dbus.DBusException:
+            try:
+                objects = self._crawl()
+            except dbus.DBusException as e:
+                self.errors[self.path] = e
+                objects = {}
+
+        self.tree.prune(self.path)
+        self.tree.update(
+            (k, v) for k, v in objects.iteritems() if v)
+
+    def _name_owner_changed(self, name, old, new):
+        self._follow(str(new) if new else None)
+        if old:
+            self.tree.prune(self.path)
+        if new and self._resync_source is None:
+            ## seeding makes blocking calls to the service
+            self._resync_source = gobject.idle_add(self._idle_resync)
+
+    def _idle_resync(self):
+        self._resync_source = None
+        if self.owner is not None:
+            self.resync()
+        return False
+
+    def _interfaces_added(self, path, interfaces, **kw):
+        if not self._in_subtree(path):
+            return
+
+        interfaces = self._filter_interfaces(interfaces)
+        if not interfaces:
+            return
+
+        data = dict(self.tree.get(path) or {})
+        data.update(interfaces)
+        self.tree[str(path)] = data
+
+    def _interfaces_removed(self, path, interfaces, **kw):
+        if not self._in_subtree(path):
+            return
+
+        data = self.tree.get(path)
+        if data is None:
+            return
+
+        data = dict(
+            (k, v) for k, v in data.iteritems() if k not in interfaces)
+        if data:
+            self.tree[path] = data
+        elif self.tree.get_children(path):
+            self.tree.demote(path)
+        else:
+            self.tree.prune(path)
+
+    def _properties_changed(
+            self, interface, changed, invalidated, signal_path=None):
+        data = self.tree.get(signal_path)
+        if data is None or interface not in data:
+            return
+
+        ## replace rather than modify the stored dicts so snapshots of
+        ## the tree are not affected
+        data = dict(data)
+        props = data[interface] = dict(data[interface])
+        props.update(changed)
+        for name in invalidated:
+            props.pop(name, None)
+        self.tree[signal_path] = data
+
+        if invalidated:
+            self._refresh(signal_path, interface, invalidated)
+
+    def _refresh(self, path, interface, names):
+        obj = self.bus.get_object(self.name, path, introspect=False)
+
+        def reply(value, name):
+            self._properties_changed(
+                interface, {name: value}, [], signal_path=path)
+
+        def error(e, name):
+            self.errors[path] = e
+
+        for name in names:
+            obj.Get(
+                interface, name,
+                dbus_interface=dbus.PROPERTIES_IFACE,
+                reply_handler=lambda x, n=name: reply(x, n),
+                error_handler=lambda e, n=name: error(e, n))
+
+    def __contains__(self, path):
+        return path in self.tree
+
+    def __getitem__(self, path):
+        return self.tree[path]
+
+    def get(self, path, default=None):
+        return self.tree.get(path, default)
+
+    def get_properties(self, path, interface):
+        return self.tree[path][interface]
+
+    def get_property(self, path, interface, name, default=None):
+        try:
+            return self.tree[path][interface][name]
+        except KeyError:
+            return default
+
+    def get_objects(self, subtree=None):
+        return self.tree.dataitems(subtree or self.path)
+
+    def get_implementing(self, interface):
+        return self.tree.indexed_items(interface)
@@ -15,10 +15,231 @@
 # permissions and limitations under the License.
 
 import os
+import atexit
 import cPickle
-import json
+import cStringIO
+import hashlib
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import dbus
+import gobject
 
 CACHE_PATH = '/var/cache/obmc/'
+CACHE_DB = 'properties.db'
+WRITE_DELAY = 5.0
+FORMAT_MAGIC = 'OBMC\x03'
+
+## the writer thread only runs while the main loop is polling if GLib
+## released the GIL from the start of MainLoop.run(), which needs
+## threads enabled before the loop is started
+gobject.threads_init()
+
+## Cached values are pickled as plain data only.  The items of a
+## property dict or other container are stored as a string of their
+## type codes and a list of their builtin base values.  The codes are
+## D-Bus signature codes, upper case codes for builtin types, and '*'
+## for nested containers and None, which are stored tagged with their
+## own code.  The reader refuses to look up any class or function,
+## checks every value against its code, and then converts it to the
+## type the code names.
+
+_TYPES = {
+    'y': dbus.Byte,
+    'b': dbus.Boolean,
+    'n': dbus.Int16,
+    'q': dbus.UInt16,
+    'i': dbus.Int32,
+    'u': dbus.UInt32,
+    'x': dbus.Int64,
+    't': dbus.UInt64,
+    'd': dbus.Double,
+    's': dbus.String,
+    'S': dbus.UTF8String,
+    'o': dbus.ObjectPath,
+    'g': dbus.Signature,
+    'Y': dbus.ByteArray,
+    'T': bool,
+    'I': int,
+    'L': long,
+    'F': float,
+    'B': str,
+    'U': unicode,
+    '*': tuple,
+}
+
+
+def _base_type(cls):
+    for base in (bool, int, long, float, str, unicode, tuple):
+        if issubclass(cls, base):
+            return base
+
+
+## code -> the builtin type a value is stored as
+_BASES = dict((k, _base_type(v)) for k, v in _TYPES.iteritems())
+_CONTAINER_CODES = {
+    dbus.Array: 'a',
+    dbus.Struct: 'r',
+    dbus.Dictionary: 'e',
+    list: 'l',
+    tuple: 'P',
+    dict: 'm',
+    type(None): 'N',
+}
+_MAPPING_CODES = frozenset(['e', 'm'])
+## type -> code
+_TYPE_CODES = dict((v, k) for k, v in _TYPES.iteritems())
+_TYPE_CODES.update((k, '*') for k in _CONTAINER_CODES)
+
+
+def _tag_items(items):
+    codes = map(_TYPE_CODES.get, map(type, items))
+    if None in codes:
+        raise TypeError(repr(items[codes.index(None)]) + ' cannot be cached')
+    ## apply() keeps the loop over the items in C
+    return ''.join(codes), map(
+        apply, map(_TO_BASE.__getitem__, codes), zip(items))
+
+
+def _tag(o):
+    code = _TYPE_CODES.get(type(o))
+    if code is None:
+        raise TypeError(repr(o) + ' cannot be cached')
+    if code != '*':
+        return (code, _BASES[code](o))
+
+    code = _CONTAINER_CODES[type(o)]
+    if code == 'N':
+        return (code,)
+    signature = getattr(o, 'signature', None)
+    if code in _MAPPING_CODES:
+        items = o.keys() + o.values()
+    else:
+        items = list(o)
+    return (code, signature and str(signature)) + _tag_items(items)
+
+
+## code string -> (base types, functions restoring the values or None
+## if there is nothing to restore); the property dicts of one kind of
+## object share a few of these
+_SHAPES = {}
+_MAX_SHAPES = 1024
+
+
+def _shape(codes):
+    shape = _SHAPES.get(codes)
+    if shape is not None:
+        return shape
+
+    unknown = set(codes).difference(_TYPES)
+    if unknown:
+        raise ValueError('unknown type code ' + repr(unknown.pop()))
+    bases = map(_BASES.__getitem__, codes)
+    restore = map(_FROM_BASE.__getitem__, codes)
+    shape = (bases, None if restore == bases else restore)
+    if len(_SHAPES) >= _MAX_SHAPES:
+        _SHAPES.clear()
+    _SHAPES[codes] = shape
+    return shape
+
+
+def _untag_items(codes, items):
+    bases, restore = _shape(codes)
+    if map(type, items) != bases:
+        raise ValueError('values do not match their type codes')
+    if restore is None:
+        return items
+    return map(apply, restore, zip(items))
+
+
+def _pairs(items):
+    if len(items) % 2:
+        raise ValueError('odd number of mapping items')
+    n = len(items) / 2
+    return zip(items[:n], items[n:])
+
+
+def _untag(o):
+    code = o[0]
+    if code == 'N':
+        return None
+    if len(o) == 2:
+        if code not in _TYPES or code == '*':
+            raise ValueError('unknown type code ' + repr(code))
+        if type(o[1]) is not _BASES[code]:
+            raise ValueError('value does not match type code ' + repr(code))
+        return _TYPES[code](o[1])
+
+    code, signature, codes, items = o
+    items = _untag_items(codes, items)
+    if code == 'a':
+        return dbus.Array(items, signature=signature)
+    if code == 'r':
+        return dbus.Struct(items, signature=signature)
+    if code == 'e':
+        return dbus.Dictionary(_pairs(items), signature=signature)
+    if code == 'm':
+        return dict(_pairs(items))
+    if code == 'P':
+        return tuple(items)
+    if code == 'l':
+        return items
+    raise ValueError('unknown container code ' + repr(code))
+
+
+## code -> function storing a value as its base type, and restoring it
+_TO_BASE = dict(_BASES, **{'*': _tag})
+_FROM_BASE = dict(_TYPES, **{'*': _untag})
+
+
+def encode(value):
+    ''' Serialize value, which may contain dbus-python types, so that
+    decode() restores the same types.
+
+    Raises TypeError if value holds anything but plain data and
+    dbus-python types.
+    '''
+
+    if type(value) is dict:
+        entry = ('F',) + _tag_items(value.keys() + value.values())
+    else:
+        entry = ('V', _tag(value))
+    return FORMAT_MAGIC + cPickle.dumps(entry, 2)
+
+
+def _load(data, start=0):
+    stream = cStringIO.StringIO(data)
+    stream.seek(start)
+    unpickler = cPickle.Unpickler(stream)
+    unpickler.find_global = None
+    value = unpickler.load()
+    if stream.read(1):
+        raise ValueError('trailing data')
+    return value
+
+
+def decode(data):
+    ''' Reverse encode().  Caches written by earlier versions as plain
+    pickles are read with the same unpickler, which refuses to look up
+    any class or function, so it can only produce builtin types.
+
+    Raises ValueError if data is not a valid cache entry.
+    '''
+
+    try:
+        if not data.startswith(FORMAT_MAGIC):
+            return _load(data)
+
+        entry = _load(data, len(FORMAT_MAGIC))
+        if entry[0] == 'F' and len(entry) == 3:
+            return dict(_pairs(_untag_items(entry[1], entry[2])))
+        if entry[0] == 'V' and len(entry) == 2:
+            return _untag(entry[1])
+        raise ValueError('unknown entry type')
+    except Exception as e:
+        raise ValueError('invalid property cache data: ' + repr(e))
 
 
 def getCacheFilename(obj_path, iface_name):
@@ -27,39 +248,394 @@ def getCacheFilename(obj_path, iface_name):
     return filename
 
 
-def save(obj_path, iface_name, properties):
-    print "Caching: "+obj_path
-    filename = getCacheFilename(obj_path, iface_name)
+def parseCacheFilename(filename):
+    name, _, iface_name = os.path.basename(filename).partition('@')
+    if not iface_name.endswith('.props'):
+        return None, None
+    return '/' + name.replace('.', '/'), iface_name[:-len('.props')]
+
+
+def _in_subtree(obj_path, prefix):
+    prefix = prefix.rstrip('/')
+    return not prefix or obj_path == prefix or \
+        obj_path.startswith(prefix + '/')
+
+
+def write_atomic(filename, data):
     parent = os.path.dirname(filename)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    fd, tmp = tempfile.mkstemp(dir=parent, prefix='.tmp')
     try:
-        if not os.path.exists(parent):
-            os.makedirs(parent)
-        with open(filename, 'wb') as output:
-            try:
-                ## use json module to convert dbus datatypes
-                props = json.dumps(properties[iface_name])
-                prop_obj = json.loads(props)
-                cPickle.dump(prop_obj, output)
-            except Exception as e:
-                print "ERROR: "+str(e)
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.rename(tmp, filename)
     except:
-        print "ERROR opening cache file: "+filename
+        os.unlink(tmp)
+        raise
 
+    dirfd = os.open(parent, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
 
-def load(obj_path, iface_name, properties):
-    ## overlay with pickled data
-    filename = getCacheFilename(obj_path, iface_name)
-    if (os.path.isfile(filename)):
-        if iface_name in properties:
-            properties[iface_name] = {}
-        print "Loading from cache: "+filename
+
+class FileBackend(object):
+    ''' One file per (object, interface) under CACHE_PATH. '''
+
+    def write_many(self, items):
+        for (obj_path, iface_name), data in items:
+            write_atomic(getCacheFilename(obj_path, iface_name), data)
+
+    def read(self, obj_path, iface_name):
+        filename = getCacheFilename(obj_path, iface_name)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def read_all(self, prefix='/'):
         try:
-            p = open(filename, 'rb')
-            data = cPickle.load(p)
-            for prop in data.keys():
-                properties[iface_name][prop] = data[prop]
+            names = os.listdir(CACHE_PATH)
+        except OSError:
+            return
+
+        for name in names:
+            obj_path, iface_name = parseCacheFilename(name)
+            if obj_path is None or not _in_subtree(obj_path, prefix):
+                continue
+            with open(os.path.join(CACHE_PATH, name), 'rb') as f:
+                yield obj_path, iface_name, f.read()
+
+
+class SqliteBackend(object):
+    ''' All cached properties in a single sqlite database, indexed by
+    object path and interface.
+    '''
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(CACHE_PATH, CACHE_DB)
+        parent = os.path.dirname(filename)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS properties ('
+            'path TEXT NOT NULL, interface TEXT NOT NULL, data BLOB, '
+            'PRIMARY KEY (path, interface))')
+        self.db.commit()
+
+    def write_many(self, items):
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO properties VALUES (?, ?, ?)',
+                    ((k[0], k[1], sqlite3.Binary(v)) for k, v in items))
+
+    def read(self, obj_path, iface_name):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM properties WHERE path = ? AND '
+                'interface = ?', (obj_path, iface_name)).fetchone()
+        return str(row[0]) if row else None
+
+    def read_all(self, prefix='/'):
+        prefix = prefix.rstrip('/')
+        with self.lock:
+            if prefix:
+                rows = self.db.execute(
+                    'SELECT path, interface, data FROM properties WHERE '
+                    'path = ? OR (path >= ? AND path < ?)',
+                    (prefix, prefix + '/', prefix + '0')).fetchall()
+            else:
+                rows = self.db.execute(
+                    'SELECT path, interface, data FROM properties').fetchall()
+
+        for obj_path, iface_name, data in rows:
+            yield obj_path, iface_name, str(data)
 
+    def import_files(self, remove=False):
+        ''' Copy the per-file caches under CACHE_PATH into the database,
+        optionally removing them afterwards.  Returns the number of
+        entries imported.
+        '''
+
+        files = FileBackend()
+        items = [((obj_path, iface_name), data)
+                 for obj_path, iface_name, data in files.read_all()]
+        self.write_many(items)
+
+        if remove:
+            for (obj_path, iface_name), data in items:
+                os.unlink(getCacheFilename(obj_path, iface_name))
+
+        return len(items)
+
+
+class CacheWriter(threading.Thread):
+    ''' A background thread writing cache entries behind the caller.
+
+    Repeated saves of an entry within delay seconds are coalesced into
+    one write, writes whose content matches what was last written are
+    skipped, and each write replaces the entry atomically.  Writes are
+    serialized, and entries whose write failed are queued again.
+    Anything pending is written by flush(), and by stop() at
+    interpreter exit.
+    '''
+
+    def __init__(self, backend, delay=WRITE_DELAY):
+        super(CacheWriter, self).__init__(name='propertycacher')
+        self.daemon = True
+        self.backend = backend
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.hashes = {}
+        self.writes = 0
+        self.skipped = 0
+        self.stopped = False
+
+    def save(self, key, data):
+        with self.cond:
+            due = self.pending.get(key, (None, None))[1]
+            if due is None:
+                due = time.time() + self.delay
+            self.pending[key] = (data, due)
+            self.cond.notify()
+
+    def _take(self, now=None):
+        with self.cond:
+            if now is None:
+                ready = self.pending
+                self.pending = {}
+            else:
+                ready = dict((k, v) for k, v in self.pending.iteritems()
+                             if v[1] <= now)
+                for k in ready:
+                    del self.pending[k]
+        return ready
+
+    def _write(self, ready):
+        items = []
+        for key, (data, due) in ready.iteritems():
+            digest = hashlib.sha1(data).digest()
+            if self.hashes.get(key) == digest:
+                self.skipped += 1
+                continue
+            items.append((key, data, digest))
+
+        if not items:
+            return
+
+        try:
+            self.backend.write_many((k, d) for k, d, h in items)
         except Exception as e:
-            print "ERROR: Loading cache file: " + str(e)
+            print "ERROR writing property cache: "+str(e)
+            self._requeue(items)
+            return
+
+        for key, data, digest in items:
+            self.hashes[key] = digest
+        self.writes += len(items)
+
+    def _requeue(self, items):
+        ## retry after another delay, unless a newer save replaced it
+        due = time.time() + self.delay
+        with self.cond:
+            for key, data, digest in items:
+                if key not in self.pending:
+                    self.pending[key] = (data, due)
+            self.cond.notify()
+
+    def _write_ready(self, now=None):
+        ## taking and writing under one lock keeps an older value taken
+        ## by one writer from landing after a newer one
+        with self.write_lock:
+            self._write(self._take(now))
+
+    def set_backend(self, backend):
+        with self.write_lock:
+            self._write(self._take())
+            self.backend = backend
+
+    def flush(self, blocking=True):
+        ''' Write every pending save now.  Returns False without writing
+        if blocking is False and a write is already in progress.
+        '''
+
+        if not self.write_lock.acquire(blocking):
+            return False
+        try:
+            self._write(self._take())
         finally:
-            p.close()
+            self.write_lock.release()
+        return True
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.join()
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                due = min(v[1] for v in self.pending.itervalues())
+                timeout = due - time.time()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+            self._write_ready(time.time())
+
+
+_backend = FileBackend()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def set_backend(backend):
+    ''' Use backend, a FileBackend or SqliteBackend, for subsequent
+    saves and loads.  Pending saves are written to the old backend
+    first.
+    '''
+
+    global _backend, _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.set_backend(backend)
+        _backend = backend
+
+
+def get_writer():
+    ''' Return the writer thread, starting it on first use.
+
+    Saves reach the backend up to WRITE_DELAY seconds later.  Pending
+    saves are written when the interpreter exits normally, but atexit
+    hooks do not run when a process is killed by a signal, including
+    the SIGTERM systemd stops services with.  Services should call
+    flush() on their way out, or use flush_on_signals().
+    '''
+
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = CacheWriter(_backend)
+            _writer.start()
+            atexit.register(_writer.stop)
+    return _writer
+
+
+def flush():
+    ''' Write every pending save now. '''
+
+    if _writer is not None:
+        _writer.flush()
+
+
+def flush_on_signals(signals=(signal.SIGTERM, signal.SIGINT)):
+    ''' Install handlers that flush pending saves when one of signals
+    arrives, then hand the signal to the handler that was installed
+    before, or redeliver it with its default action.
+    '''
+
+    previous = {}
+
+    def finish(signum):
+        flush()
+        os.kill(os.getpid(), signum)
+
+    def handler(signum, frame):
+        ## the handler may have interrupted a flush() or set_backend()
+        ## holding the write lock, so it must not wait for it
+        flushed = _writer is None or _writer.flush(blocking=False)
+        prev = previous.get(signum)
+        if callable(prev):
+            return prev(signum, frame)
+        if prev == signal.SIG_IGN:
+            return
+        signal.signal(signum, signal.SIG_DFL)
+        if flushed:
+            os.kill(os.getpid(), signum)
+            return
+
+        ## finish once the interrupted write releases the lock
+        thread = threading.Thread(target=finish, args=(signum,))
+        thread.daemon = True
+        thread.start()
+
+    for signum in signals:
+        previous[signum] = signal.signal(signum, handler)
+
+
+def save(obj_path, iface_name, properties):
+    print "Caching: "+obj_path
+    try:
+        data = encode(properties[iface_name])
+    except Exception as e:
+        print "ERROR: "+str(e)
+        return
+
+    get_writer().save((obj_path, iface_name), data)
+
+
+def load(obj_path, iface_name, properties):
+    ''' Overlay properties[iface_name] with the cached values.
+
+    properties is written directly, without a signal or a change of
+    DbusObjectManager.generation, so load an object before it is added
+    to its manager, or call _properties_stored() on it afterwards.
+    '''
+
+    try:
+        data = None
+        if _writer is not None:
+            with _writer.cond:
+                data = _writer.pending.get((obj_path, iface_name), (None,))[0]
+        if data is None:
+            data = _backend.read(obj_path, iface_name)
+    except Exception as e:
+        print "ERROR: Loading cache: " + str(e)
+        return
+
+    if data is None:
+        return
+
+    properties[iface_name] = {}
+    print "Loading from cache: "+obj_path+"@"+iface_name
+    try:
+        properties[iface_name].update(decode(data))
+    except Exception as e:
+        print "ERROR: Loading cache: " + str(e)
+
+
+def load_all(prefix='/'):
+    ''' Return the cached properties of every object at or below
+    prefix, as a dict of object path to {interface: properties}.
+    '''
+
+    result = {}
+    for obj_path, iface_name, data in _backend.read_all(prefix):
+        try:
+            props = decode(data)
+        except Exception as e:
+            print "ERROR: Loading cache: " + str(e)
+            continue
+        result.setdefault(obj_path, {})[iface_name] = props
+
+    return result
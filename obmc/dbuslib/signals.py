@@ -0,0 +1,179 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import traceback
+import dbus
+import dbus.lowlevel
+
+
+class SignalDispatcher(object):
+    ''' Deliver D-Bus signals to any number of Python callbacks while
+    holding a single match rule on the bus per (interface, member,
+    path namespace, sender, arg0).
+
+    Unlike bus.add_signal_receiver(), which adds a rule for every
+    receiver, the rule is added when the first callback for it is
+    registered and removed with the last one.  Received signals go
+    through one message filter, which looks up the callbacks by
+    interface and member.  Use get_dispatcher() to share an instance
+    per connection.
+    '''
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.rules = {}
+        self.members = {}
+        bus.add_message_filter(self._filter)
+
+    @staticmethod
+    def _rule(interface, member, path_namespace, sender, arg0):
+        rule = ["type='signal'"]
+        if sender is not None:
+            rule.append("sender='%s'" % sender)
+        if interface is not None:
+            rule.append("interface='%s'" % interface)
+        if member is not None:
+            rule.append("member='%s'" % member)
+        if path_namespace is not None and path_namespace != '/':
+            rule.append("path_namespace='%s'" % path_namespace)
+        if arg0 is not None:
+            rule.append("arg0='%s'" % arg0)
+        return ','.join(rule)
+
+    @staticmethod
+    def _key(interface, member, path_namespace, sender, arg0):
+        if path_namespace is not None:
+            path_namespace = path_namespace.rstrip('/') or '/'
+        return (interface, member, path_namespace, sender, arg0)
+
+    def add(
+            self, callback, signal_name=None, dbus_interface=None,
+            path_namespace=None, path_keyword=None, sender_keyword=None,
+            sender=None, arg0=None):
+        ''' Call callback with the arguments of every signal matching
+        signal_name and dbus_interface emitted from an object at or
+        below path_namespace.  None matches anything.
+
+        Arguments:
+        path_keyword -- Pass the object path to callback under this
+            keyword.
+        sender_keyword -- Pass the unique name of the sender to
+            callback under this keyword.
+        sender -- Only signals sent by this connection.  Signals carry
+            the unique name of their sender, so this is a unique name,
+            or org.freedesktop.DBus for the bus daemon.
+        arg0 -- Only signals whose first argument is this string.
+        '''
+
+        key = self._key(
+            dbus_interface, signal_name, path_namespace, sender, arg0)
+        callbacks = self.rules.get(key)
+        if callbacks is None:
+            self.bus.add_match_string_non_blocking(self._rule(*key))
+            callbacks = self.rules[key] = []
+            self.members.setdefault(key[:2], {})[key[2:]] = callbacks
+
+        callbacks.append((callback, path_keyword, sender_keyword))
+
+    def remove(
+            self, callback, signal_name=None, dbus_interface=None,
+            path_namespace=None, sender=None, arg0=None):
+        ''' Undo one add() of callback with the same match arguments,
+        removing the match rule if no callbacks remain for it.
+        '''
+
+        key = self._key(
+            dbus_interface, signal_name, path_namespace, sender, arg0)
+        callbacks = self.rules.get(key, [])
+        for i, entry in enumerate(callbacks):
+            if entry[0] == callback:
+                del callbacks[i]
+                break
+        else:
+            return
+
+        if callbacks:
+            return
+
+        del self.rules[key]
+        matches = self.members[key[:2]]
+        del matches[key[2:]]
+        if not matches:
+            del self.members[key[:2]]
+        self.bus.remove_match_string_non_blocking(self._rule(*key))
+
+    def _filter(self, connection, message):
+        if message.get_type() != dbus.lowlevel.MESSAGE_TYPE_SIGNAL or \
+                not self.members:
+            return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+        interface = message.get_interface()
+        member = message.get_member()
+        path = message.get_path()
+        sender = message.get_sender()
+        args = None
+        matched = []
+        for k in [
+                (interface, member), (interface, None),
+                (None, member), (None, None)]:
+            for (namespace, sent_by, arg0), callbacks in \
+                    self.members.get(k, {}).iteritems():
+                if namespace is not None and namespace != '/' and \
+                        path != namespace and \
+                        not path.startswith(namespace + '/'):
+                    continue
+                if sent_by is not None and sent_by != sender:
+                    continue
+                if arg0 is not None:
+                    if args is None:
+                        args = message.get_args_list()
+                    if not args or args[0] != arg0:
+                        continue
+                matched.extend(callbacks)
+
+        if matched:
+            if args is None:
+                args = message.get_args_list()
+            for callback, path_keyword, sender_keyword in matched:
+                kw = {}
+                if path_keyword:
+                    kw[path_keyword] = path
+                if sender_keyword:
+                    kw[sender_keyword] = sender
+                try:
+                    callback(*args, **kw)
+                except Exception:
+                    traceback.print_exc()
+
+        return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+    def stats(self):
+        return {
+            'rules': len(self.rules),
+            'callbacks': sum(len(x) for x in self.rules.itervalues()),
+        }
+
+
+_dispatchers = {}
+
+
+def get_dispatcher(bus):
+    ''' Return the process wide SignalDispatcher for bus. '''
+
+    dispatcher = _dispatchers.get(bus)
+    if dispatcher is None:
+        dispatcher = _dispatchers[bus] = SignalDispatcher(bus)
+    return dispatcher
@@ -0,0 +1,155 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import os
+import select
+import gobject
+from obmc.enums import GPIO_DEV
+from obmc.utils.misc import read_at_start
+
+
+class Gpio(object):
+    ''' A sysfs GPIO line, exported and configured once, with its value
+    file held open.
+
+    Arguments:
+    num -- The kernel GPIO number.
+    direction -- 'in', 'out', 'high' or 'low', or None to leave as is.
+    edge -- 'none', 'rising', 'falling' or 'both', or None to leave as
+        is.  Edges are delivered by GpioMonitor.
+    active_low -- True or False, or None to leave as is.
+    gpio_dev -- The sysfs GPIO class directory.
+    '''
+
+    def __init__(
+            self, num, direction=None, edge=None, active_low=None,
+            gpio_dev=GPIO_DEV):
+        self.num = num
+        self.gpio_dev = gpio_dev
+        self.path = os.path.join(gpio_dev, 'gpio' + str(num))
+        self.fd = None
+
+        if not os.path.isdir(self.path):
+            with open(os.path.join(gpio_dev, 'export'), 'w') as f:
+                f.write(str(num))
+
+        if active_low is not None:
+            self._configure('active_low', '1' if active_low else '0')
+        if direction is not None:
+            self._configure('direction', direction)
+        if edge is not None:
+            self._configure('edge', edge)
+
+        self.output = self._attribute('direction') != 'in'
+        self.fd = os.open(
+            os.path.join(self.path, 'value'),
+            os.O_RDWR if self.output else os.O_RDONLY)
+
+    def _attribute(self, name):
+        with open(os.path.join(self.path, name)) as f:
+            return f.read().strip()
+
+    def _configure(self, name, value):
+        current = self._attribute(name)
+        if name == 'direction' and value in ('high', 'low'):
+            ## 'high' and 'low' switch to output at that level; a line
+            ## that is already an output only needs its level set
+            if current == 'out':
+                name = 'value'
+                value = '1' if value == 'high' else '0'
+                current = self._attribute(name)
+        if current == value:
+            return
+
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(value)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        return 1 if read_at_start(self.fd, 2)[:1] == '1' else 0
+
+    def write(self, value):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, '1' if value else '0')
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def read_many(gpios):
+    ''' Return the values of gpios, in order. '''
+
+    result = []
+    for gpio in gpios:
+        result.append(1 if read_at_start(gpio.fd, 2)[:1] == '1' else 0)
+    return result
+
+
+class GpioMonitor(object):
+    ''' Deliver edges on input Gpios configured with an edge.
+
+    sysfs reports an edge as POLLPRI on the value file.  Each watched
+    line is added to the GLib main loop with io_add_watch(IO_PRI), and
+    to a select.poll object for wait(), which blocks for edges without
+    a main loop.  Callbacks are called as callback(gpio, value).
+    '''
+
+    def __init__(self):
+        self.watches = {}
+        self.poller = select.poll()
+
+    def add(self, gpio, callback):
+        self.remove(gpio)
+
+        ## clear the initial readiness so the first event is an edge
+        gpio.read()
+        source = gobject.io_add_watch(
+            gpio.fd, gobject.IO_PRI | gobject.IO_ERR,
+            self._io_event, gpio)
+        self.poller.register(gpio.fd, select.POLLPRI | select.POLLERR)
+        self.watches[gpio.fd] = (gpio, callback, source)
+
+    def remove(self, gpio):
+        watch = self.watches.pop(gpio.fd, None)
+        if watch is None:
+            return
+
+        gobject.source_remove(watch[2])
+        self.poller.unregister(gpio.fd)
+
+    def _dispatch(self, fd):
+        gpio, callback = self.watches[fd][:2]
+        callback(gpio, gpio.read())
+
+    def _io_event(self, fd, condition, gpio):
+        if fd in self.watches:
+            self._dispatch(fd)
+        return True
+
+    def wait(self, timeout=None):
+        ''' Wait up to timeout milliseconds for edges, dispatching them,
+        and return the number of lines that changed.
+        '''
+
+        events = self.poller.poll(timeout)
+        for fd, event in events:
+            if fd in self.watches:
+                self._dispatch(fd)
+        return len(events)
@@ -16,29 +16,235 @@
 
 import os
 import subprocess
+import time
+from array import array
 import dbus
 import dbus.service
+import dbus.exceptions
+import gobject
 from obmc.dbuslib.bindings import DbusProperties
+from obmc.dbuslib.signals import get_dispatcher
+from obmc.utils.misc import read_at_start
+
+
+class Deadband(object):
+    ''' Rules deciding when a sensor value is worth publishing.
+
+    Arguments:
+    absolute -- Publish when the value moves more than this far from
+        the last published value.
+    percent -- Publish when the value moves more than this percentage
+        of the last published value.
+    min_interval -- Never publish more often than this many seconds.
+    max_interval -- Publish the current value at least this often, in
+        seconds, even if it has not left the band.
+    '''
+
+    def __init__(
+            self, absolute=None, percent=None,
+            min_interval=None, max_interval=None):
+        self.absolute = absolute
+        self.percent = percent
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def exceeded(self, old, new):
+        try:
+            delta = abs(new - old)
+        except TypeError:
+            return new != old
+
+        if self.absolute is not None and delta > self.absolute:
+            return True
+        if self.percent is not None and \
+                delta > abs(old) * self.percent / 100.0:
+            return True
+        return self.absolute is None and self.percent is None and \
+            delta != 0
+
+
+class SampleHistory(object):
+    ''' A fixed size ring buffer of (timestamp, value) samples.
+
+    Samples are stored in two array('d') buffers allocated up front, so
+    memory is bounded by size and appending is O(1).
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        i = self.head
+        self.times[i] = timestamp
+        self.values[i] = value
+        self.head = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def last(self, n):
+        ''' Return up to n of the newest samples, oldest first. '''
+
+        n = min(n, self.count)
+        start = (self.head - n) % self.size
+        if start + n <= self.size:
+            idx = range(start, start + n)
+        else:
+            idx = range(start, self.size) + range(0, start + n - self.size)
+        return [(self.times[i], self.values[i]) for i in idx]
+
+    def window(self, seconds, now=None):
+        ''' Return (count, min, max, mean) of the samples taken in the
+        last seconds, walking back from the newest.  min, max and mean
+        are NaN if there are none.
+        '''
+
+        if now is None:
+            now = time.time()
+        since = now - seconds
+        times = self.times
+        values = self.values
+        size = self.size
+        i = self.head
+        n = 0
+        total = 0.0
+        lo = hi = float('nan')
+        while n < self.count:
+            i = (i - 1) % size
+            if times[i] < since:
+                break
+            v = values[i]
+            if not n or v < lo:
+                lo = v
+            if not n or v > hi:
+                hi = v
+            total += v
+            n += 1
+
+        return n, lo, hi, total / n if n else float('nan')
 
 
 ## Abstract class, must subclass
 class SensorValue(DbusProperties):
     IFACE_NAME = 'org.openbmc.SensorValue'
+    deadband = None
+    history = None
 
     def __init__(self, bus, name):
+        self._published_value = None
+        self._published_time = None
+        self._deadband_source = None
         self.Set(SensorValue.IFACE_NAME, 'units', "")
         self.Set(SensorValue.IFACE_NAME, 'error', False)
 
+    def set_deadband(self, deadband):
+        self.deadband = deadband
+        if deadband is None:
+            self._cancel_deadband_timer()
+
+    def enable_history(self, size):
+        ''' Keep the last size samples passed to setValue, or stop
+        keeping them if size is 0.
+        '''
+
+        self.history = SampleHistory(size) if size else None
+
+    def _record(self, value, now=None):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        self.history.append(time.time() if now is None else now, value)
+
     @dbus.service.method(
         IFACE_NAME, in_signature='v', out_signature='')
     def setValue(self, value):
-        self.Set(SensorValue.IFACE_NAME, 'value', value)
+        if self.history is not None:
+            self._record(value)
+        if self.deadband is None:
+            self.Set(SensorValue.IFACE_NAME, 'value', value)
+        else:
+            self._filter_value(value)
+
+    def _filter_value(self, value):
+        now = time.time()
+        rule = self.deadband
+        props = self.properties.setdefault(SensorValue.IFACE_NAME, {})
+        changed = 'value' not in props or props['value'] != value
+        props['value'] = value
+
+        if self._published_time is None:
+            return self._publish_value(value, now)
+
+        elapsed = now - self._published_time
+        if rule.max_interval is not None and elapsed >= rule.max_interval:
+            return self._publish_value(value, now)
+        if not rule.exceeded(self._published_value, value):
+            return self._value_stored(changed)
+        if rule.min_interval and elapsed < rule.min_interval:
+            self._start_deadband_timer(rule.min_interval - elapsed)
+            return self._value_stored(changed)
+
+        self._publish_value(value, now)
+
+    def _value_stored(self, changed):
+        if changed:
+            self._properties_stored(SensorValue.IFACE_NAME)
+
+    def _publish_value(self, value, now):
+        self._published_value = value
+        self._published_time = now
+        self._properties_changed(SensorValue.IFACE_NAME, {'value': value})
+        if self.deadband.max_interval is not None:
+            self._start_deadband_timer(self.deadband.max_interval)
+        else:
+            self._cancel_deadband_timer()
+
+    def _cancel_deadband_timer(self):
+        if self._deadband_source is not None:
+            gobject.source_remove(self._deadband_source)
+            self._deadband_source = None
+
+    def _start_deadband_timer(self, seconds):
+        self._cancel_deadband_timer()
+        self._deadband_source = gobject.timeout_add(
+            int(seconds * 1000), self._deadband_timeout)
+
+    def _deadband_timeout(self):
+        self._deadband_source = None
+        if self.deadband is not None:
+            value = self.properties[SensorValue.IFACE_NAME].get('value')
+            self._publish_value(value, time.time())
+        return False
 
     @dbus.service.method(
         IFACE_NAME, in_signature='', out_signature='v')
     def getValue(self):
         return self.Get(SensorValue.IFACE_NAME, 'value')
 
+    @dbus.service.method(
+        IFACE_NAME, in_signature='du', out_signature='udddda(dd)')
+    def getHistory(self, seconds, last):
+        ''' Return the number of samples in the last seconds, their
+        min, max and mean, the current time and the newest last
+        samples as (timestamp, value).
+        '''
+
+        if self.history is None:
+            raise dbus.exceptions.DBusException(
+                "org.openbmc.SensorValue.Error.NoHistory: "
+                "history is not enabled")
+
+        now = time.time()
+        n, lo, hi, mean = self.history.window(seconds, now)
+        return n, lo, hi, mean, now, self.history.last(last)
+
 
 class VirtualSensor(SensorValue):
     def __init__(self, bus, name):
@@ -54,7 +260,7 @@ class BootProgressSensor(VirtualSensor):
     def __init__(self, bus, name):
         VirtualSensor.__init__(self, bus, name)
         self.setValue("Off")
-        bus.add_signal_receiver(
+        get_dispatcher(bus).add(
             self.SystemStateHandler, signal_name="GotoSystemState")
 
     def SystemStateHandler(self, state):
@@ -99,7 +305,7 @@ class OperatingSystemStatusSensor(VirtualSensor):
     def __init__(self, bus, name):
         VirtualSensor.__init__(self, bus, name)
         self.setValue("Off")
-        bus.add_signal_receiver(
+        get_dispatcher(bus).add(
             self.SystemStateHandler, signal_name="GotoSystemState")
 
     def SystemStateHandler(self, state):
@@ -141,3 +347,183 @@ class TurboAllowedSensor(VirtualSensor):
         SensorValue.IFACE_NAME, in_signature='b', out_signature='')
     def setValue(self, value):
         super(TurboAllowedSensor, self).setValue(value)
+
+
+def set_values(updates, error=None):
+    ''' Apply an iterable of (sensor, value) updates, calling setValue
+    only for sensors whose value changed.
+
+    Arguments:
+    error -- If given, exceptions raised by setValue are passed to it
+        as error(sensor, e) and the remaining updates are applied.
+    '''
+
+    now = None
+    for sensor, value in updates:
+        props = sensor.properties.get(SensorValue.IFACE_NAME)
+        if props is not None and 'value' in props and \
+                props['value'] == value:
+            if sensor.history is not None:
+                if now is None:
+                    now = time.time()
+                sensor._record(value, now)
+            continue
+        if error is None:
+            sensor.setValue(value)
+            continue
+        try:
+            sensor.setValue(value)
+        except Exception as e:
+            error(sensor, e)
+
+
+class _PolledSensor(object):
+    __slots__ = [
+        'sensor', 'filename', 'fd', 'convert', 'raw', 'value', 'failed']
+
+    def __init__(self, sensor, filename, convert):
+        self.sensor = sensor
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDONLY)
+        self.convert = convert
+        self.raw = None
+        self.value = None
+        self.failed = False
+
+
+class _PollGroup(object):
+    __slots__ = ['entries', 'tick', 'slices', 'source']
+
+    def __init__(self):
+        self.entries = []
+        self.tick = 0
+        self.slices = 0
+        self.source = None
+
+
+class SensorPoller(object):
+    ''' Feed SensorValue objects from sysfs attributes such as hwmon
+    inputs.
+
+    Sensors sharing an interval are polled by one timer, and their
+    attribute files are opened once and kept open.  Each interval is
+    split into up to slices ticks that each read an equal share of its
+    sensors, so a large group does not read everything at once.  Reads
+    that return the same text as last time are not converted or
+    published.
+
+    Arguments:
+    slices -- The most ticks to spread each interval's reads over.
+    read_size -- Bytes to read from each attribute.
+    '''
+
+    def __init__(self, slices=10, read_size=64):
+        self.slices = slices
+        self.read_size = read_size
+        self.groups = {}
+        self.sensors = {}
+        self.reads = 0
+        self.errors = 0
+
+    def add(self, sensor, filename, interval, convert=int):
+        ''' Poll filename every interval milliseconds and set sensor to
+        convert(contents).
+        '''
+
+        self.remove(sensor)
+        entry = _PolledSensor(sensor, filename, convert)
+        group = self.groups.get(interval)
+        if group is None:
+            group = self.groups[interval] = _PollGroup()
+        group.entries.append(entry)
+        self.sensors[sensor] = (interval, entry)
+        self._schedule(interval)
+
+    def remove(self, sensor):
+        interval, entry = self.sensors.pop(sensor, (None, None))
+        if entry is None:
+            return
+
+        os.close(entry.fd)
+        group = self.groups[interval]
+        group.entries.remove(entry)
+        if not group.entries:
+            if group.source is not None:
+                gobject.source_remove(group.source)
+            del self.groups[interval]
+        else:
+            self._schedule(interval)
+
+    def stop(self):
+        for sensor in self.sensors.keys():
+            self.remove(sensor)
+
+    def _schedule(self, interval):
+        group = self.groups[interval]
+        slices = max(1, min(self.slices, len(group.entries)))
+        if group.source is not None:
+            if group.slices == slices:
+                return
+            gobject.source_remove(group.source)
+
+        group.tick = 0
+        group.slices = slices
+        group.source = gobject.timeout_add(
+            max(1, interval // slices), self._poll, group)
+
+    def _poll(self, group):
+        tick = group.tick
+        group.tick = (tick + 1) % group.slices
+        self.poll(group.entries[tick::group.slices])
+        return True
+
+    def poll(self, entries=None):
+        ''' Read entries, or every polled sensor, now. '''
+
+        if entries is None:
+            entries = [x[1] for x in self.sensors.itervalues()]
+
+        updates = []
+        recovered = []
+        size = self.read_size
+        for entry in entries:
+            self.reads += 1
+            ## any failure is confined to its sensor; an exception
+            ## leaving the timer callback would stop the whole group
+            try:
+                raw = read_at_start(entry.fd, size)
+                if raw == entry.raw:
+                    if entry.sensor.history is not None:
+                        updates.append((entry.sensor, entry.value))
+                    continue
+                value = entry.convert(raw.strip())
+            except Exception as e:
+                self._set_error(entry, e)
+                continue
+
+            entry.raw = raw
+            entry.value = value
+            updates.append((entry.sensor, value))
+            if entry.failed:
+                recovered.append(entry)
+
+        set_values(updates, self._set_value_error)
+
+        for entry in recovered:
+            ## raw is cleared again if setValue failed
+            if entry.raw is not None:
+                entry.failed = False
+                entry.sensor.Set(SensorValue.IFACE_NAME, 'error', False)
+
+    def _set_value_error(self, sensor, e):
+        self._set_error(self.sensors[sensor][1], e)
+
+    def _set_error(self, entry, e):
+        self.errors += 1
+        entry.raw = None
+        if entry.failed:
+            return
+
+        print "ERROR: Reading " + entry.filename + ": " + str(e)
+        entry.failed = True
+        entry.sensor.Set(SensorValue.IFACE_NAME, 'error', True)
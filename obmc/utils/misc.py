@@ -14,6 +14,9 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import os
+
+
 def org_dot_openbmc_match_strings(sep='.', prefix=''):
     matches = [
         ['org', 'openbmc'],
@@ -48,3 +51,16 @@ def makelist(data):
             return [data]
     else:
             return []
+
+
+## sysfs attributes must be read from offset 0 to be refreshed, which
+## pread does in one system call where it is available
+_pread = getattr(os, 'pread', None)
+
+
+def read_at_start(fd, size):
+    if _pread is not None:
+        return _pread(fd, size, 0)
+
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, size)
@@ -15,20 +15,193 @@
 # permissions and limitations under the License.
 
 
+import bisect
+import collections
+import json.encoder
+import re
+import threading
+
+try:
+    from dbus import Boolean as _Boolean
+except ImportError:
+    _Boolean = bool
+
+_NO_DATA = object()
+_NO_CHILDREN = {}
+_JSON_CHUNK = 4096
+_quote = json.encoder.encode_basestring_ascii
+
+
+def _split(key):
+    return filter(bool, key.split('/'))
+
+
+def _join(elements):
+    return '/' + '/'.join(elements)
+
+
+def _has_magic(element):
+    return '*' in element or '?' in element
+
+
+def _element_regex(element):
+    return re.escape(element).replace(
+        r'\*', '[^/]*').replace(r'\?', '[^/]')
+
+
+def _glob_regex(elements):
+    parts = []
+    for e in elements:
+        if e == '**':
+            parts.append('(?:/[^/]+)*')
+        else:
+            parts.append('/' + _element_regex(e))
+    return re.compile('^' + ''.join(parts) + '$')
+
+
+def _json_float(o):
+    if o != o:
+        return 'NaN'
+    if o == float('inf'):
+        return 'Infinity'
+    if o == float('-inf'):
+        return '-Infinity'
+    return repr(float(o))
+
+
+def _json_value(o, out):
+    ''' Append the JSON encoding of o to the list out.
+
+    dbus-python types are subclasses of the builtin types and are
+    encoded directly, with dbus.Boolean written as true or false.
+    '''
+
+    if o is None:
+        out.append('null')
+    elif isinstance(o, basestring):
+        out.append(_quote(o))
+    elif o is True or o is False or isinstance(o, _Boolean):
+        out.append('true' if o else 'false')
+    elif isinstance(o, (int, long)):
+        out.append('%d' % o)
+    elif isinstance(o, float):
+        out.append(_json_float(o))
+    elif isinstance(o, dict):
+        out.append('{')
+        first = True
+        for k, v in o.iteritems():
+            if not first:
+                out.append(', ')
+            first = False
+            if not isinstance(k, basestring):
+                k = unicode(k)
+            out.append(_quote(k))
+            out.append(': ')
+            _json_value(v, out)
+        out.append('}')
+    elif isinstance(o, (list, tuple)):
+        out.append('[')
+        first = True
+        for v in o:
+            if not first:
+                out.append(', ')
+            first = False
+            _json_value(v, out)
+        out.append(']')
+    else:
+        raise TypeError(repr(o) + ' is not JSON serializable')
+
+
+class PathTreeNode(object):
+    ''' A single path element.
+
+    Leaf nodes share the read-only _NO_CHILDREN dict until a child is
+    added, and nodes without data hold the _NO_DATA sentinel, so a
+    leaf costs one slotted object.
+
+    count is the number of nodes carrying data in the subtree rooted
+    at this node, including the node itself.  gen is the generation of
+    the tree that may modify the node in place; nodes from older
+    generations are shared with snapshots and are copied on write.
+    '''
+
+    __slots__ = ('children', 'data', 'count', 'gen')
+
+    def __init__(self, gen=0):
+        self.children = _NO_CHILDREN
+        self.data = _NO_DATA
+        self.count = 0
+        self.gen = gen
+
+    def __getstate__(self):
+        children = self.children if self.children else None
+        return children, self.has_data(), self.get_data(), self.count, \
+            self.gen
+
+    def __setstate__(self, state):
+        children, has_data, data, self.count, self.gen = state
+        self.children = children if children else _NO_CHILDREN
+        self.data = data if has_data else _NO_DATA
+
+    def copy(self, gen):
+        node = PathTreeNode(gen)
+        if self.children is not _NO_CHILDREN:
+            node.children = dict(self.children)
+        node.data = self.data
+        node.count = self.count
+        return node
+
+    def has_data(self):
+        return self.data is not _NO_DATA
+
+    def get_data(self):
+        return None if self.data is _NO_DATA else self.data
+
+    def child(self, name):
+        if self.children is _NO_CHILDREN:
+            self.children = {}
+        node = self.children.get(name)
+        if node is None:
+            node = PathTreeNode(self.gen)
+            ## intern() only takes byte strings; unicode and dbus.String
+            ## segments are stored as they are
+            if type(name) is str:
+                name = intern(name)
+            self.children[name] = node
+        elif node.gen != self.gen:
+            node = node.copy(self.gen)
+            self.children[name] = node
+        return node
+
+    def remove_child(self, name):
+        del self.children[name]
+        if not self.children:
+            self.children = _NO_CHILDREN
+
+
 class PathTreeItemIterator(object):
-    def __init__(self, path_tree, subtree, depth):
+    DEPTH_FIRST = 'depth'
+    BREADTH_FIRST = 'breadth'
+
+    def __init__(
+            self, path_tree, subtree, depth,
+            order=DEPTH_FIRST, data_only=False):
         self.path_tree = path_tree
-        self.path = []
-        self.itlist = []
-        self.subtree = ['/'] + filter(bool, subtree.split('/'))
         self.depth = depth
-        d = path_tree.root
-        for k in self.subtree:
-            try:
-                d = d[k]['children']
-            except KeyError:
-                raise KeyError(subtree)
-        self.it = d.iteritems()
+        self.data_only = data_only
+        elements = _split(subtree)
+        try:
+            node = path_tree._walk(elements)
+        except KeyError:
+            raise KeyError(subtree)
+
+        prefix = '/' + '/'.join(elements) + '/' if elements else '/'
+        if order == self.BREADTH_FIRST:
+            self.it = self._breadth_first(node, prefix)
+        elif order == self.DEPTH_FIRST:
+            self.it = self._depth_first(node, prefix)
+        else:
+            raise ValueError(order)
 
     def __iter__(self):
         return self
@@ -37,105 +210,175 @@ class PathTreeItemIterator(object):
         return super(PathTreeItemIterator, self).next()
 
     def next(self):
-        key, value = self._next()
-        path = self.subtree[0] + '/'.join(self.subtree[1:] + self.path)
-        return path, value.get('data')
-
-    def _next(self):
-        try:
-            while True:
-                x = self.it.next()
-                depth_exceeded = len(self.path) + 1 > self.depth
-                if self.depth and depth_exceeded:
-                    continue
-                self.itlist.append(self.it)
-                self.path.append(x[0])
-                self.it = x[1]['children'].iteritems()
-                break
-
-        except StopIteration:
-            if not self.itlist:
-                raise StopIteration
+        return self.it.next()
 
-            self.it = self.itlist.pop()
-            self.path.pop()
-            x = self._next()
-
-        return x
+    def _descend(self, level, node):
+        if self.depth and level >= self.depth:
+            return False
+        return bool(node.children)
+
+    def _depth_first(self, node, prefix):
+        stack = [(prefix, 1, node.children.iteritems())]
+        while stack:
+            prefix, level, it = stack[-1]
+            for name, child in it:
+                path = prefix + name
+                data = child.get_data()
+                if data is not None or not self.data_only:
+                    yield path, data
+                if self._descend(level, child):
+                    stack.append(
+                        (path + '/', level + 1, child.children.iteritems()))
+                    break
+            else:
+                stack.pop()
+
+    def _breadth_first(self, node, prefix):
+        queue = collections.deque([(prefix, 1, node)])
+        while queue:
+            prefix, level, node = queue.popleft()
+            for name, child in node.children.iteritems():
+                path = prefix + name
+                data = child.get_data()
+                if data is not None or not self.data_only:
+                    yield path, data
+                if self._descend(level, child):
+                    queue.append((path + '/', level + 1, child))
 
 
 class PathTreeKeyIterator(PathTreeItemIterator):
-    def __init__(self, path_tree, subtree, depth):
-        super(PathTreeKeyIterator, self).__init__(path_tree, subtree, depth)
+    def __init__(self, path_tree, subtree, depth, **kw):
+        super(PathTreeKeyIterator, self).__init__(
+            path_tree, subtree, depth, **kw)
 
     def next(self):
         return super(PathTreeKeyIterator, self).next()[0]
 
 
 class PathTree:
-    def __init__(self):
-        self.root = {}
-
-    def _try_delete_parent(self, elements):
-        if len(elements) == 1:
-            return False
-
-        kids = 'children'
-        elements.pop()
+    ''' A tree of slash separated paths.
+
+    index, if given, is called with the data of each path and returns
+    the keys (interface names, for example) under which that path is
+    indexed for iterindexed().
+
+    None is not data: a path set to None is kept in the tree, as if
+    demoted, but is not counted by len(), count() or 'in', and is
+    skipped by the data-only iterators.
+    '''
+
+    def __init__(self, index=None):
+        self.lock = threading.Lock()
+        self.gen = 0
+        self.root = PathTreeNode(self.gen)
+        self.index = index
+        self.indexed = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _add_index(self, path, data):
+        if data is None or data is _NO_DATA:
+            return
+        for k in self.index(data):
+            self.indexed.setdefault(k, set()).add(path)
+
+    def _remove_index(self, path, data):
+        if data is None or data is _NO_DATA:
+            return
+        for k in self.index(data):
+            paths = self.indexed.get(k)
+            if paths is None:
+                continue
+            paths.discard(path)
+            if not paths:
+                del self.indexed[k]
+
+    def _walk(self, elements):
         d = self.root
-        for k in elements[:-1]:
-            d = d[k][kids]
-
-        if 'data' not in d[elements[-1]] and not d[elements[-1]][kids]:
-            del d[elements[-1]]
-            self._try_delete_parent(elements)
+        for k in elements:
+            d = d.children[k]
+        return d
 
     def _get_node(self, key):
-        kids = 'children'
-        elements = ['/'] + filter(bool, key.split('/'))
-        d = self.root
-        for k in elements[:-1]:
-            try:
-                d = d[k][kids]
-            except KeyError:
-                raise KeyError(key)
+        try:
+            return self._walk(_split(key))
+        except KeyError:
+            raise KeyError(key)
+
+    def _own_root(self):
+        if self.root.gen != self.gen:
+            self.root = self.root.copy(self.gen)
+        return self.root
 
-        return d[elements[-1]]
+    def _own_nodes(self, elements):
+        self._walk(elements)
+        return self._make_nodes(elements)
 
     def __iter__(self):
         return self
 
     def __missing__(self, key):
-        for x in self.iterkeys():
-            if key == x:
-                return False
-        return True
+        try:
+            self._walk(_split(key))
+        except KeyError:
+            return True
+        return False
 
-    def __delitem__(self, key):
-        kids = 'children'
-        elements = ['/'] + filter(bool, key.split('/'))
+    def __contains__(self, key):
         d = self.root
-        for k in elements[:-1]:
-            try:
-                d = d[k][kids]
-            except KeyError:
-                raise KeyError(key)
+        for k in _split(key):
+            d = d.children.get(k)
+            if d is None:
+                return False
+        return d.has_data()
 
-        del d[elements[-1]]
-        self._try_delete_parent(elements)
+    def __len__(self):
+        return self.count()
+
+    def __delitem__(self, key):
+        self._get_node(key)
+        self.prune(key)
+
+    def _make_nodes(self, elements):
+        d = self._own_root()
+        nodes = [d]
+        for k in elements:
+            n = d.children.get(k)
+            if n is None or n.gen != self.gen:
+                n = d.child(k)
+            d = n
+            nodes.append(d)
+        return nodes
 
     def __setitem__(self, key, value):
-        kids = 'children'
-        elements = ['/'] + filter(bool, key.split('/'))
-        d = self.root
-        for k in elements[:-1]:
-            d = d.setdefault(k, {kids: {}})[kids]
+        with self.lock:
+            self._set(_split(key), value)
+
+    def _set(self, elements, value):
+        nodes = self._make_nodes(elements)
+        d = nodes[-1]
+        if self.index and d.has_data():
+            self._remove_index(_join(elements), d.data)
 
-        children = d.setdefault(elements[-1], {kids: {}})[kids]
-        d[elements[-1]].update({kids: children, 'data': value})
+        data = _NO_DATA if value is None else value
+        added = (data is not _NO_DATA) - d.has_data()
+        if added:
+            for n in nodes:
+                n.count += added
+
+        d.data = data
+        if self.index:
+            self._add_index(_join(elements), value)
 
     def __getitem__(self, key):
-        return self._get_node(key).get('data')
+        return self._get_node(key).get_data()
 
     def setdefault(self, key, default):
         if not self.get(key):
@@ -152,12 +395,130 @@ class PathTree:
         return x
 
     def get_children(self, key):
-        return [x for x in self._get_node(key)['children'].iterkeys()]
+        return [x for x in self._get_node(key).children.iterkeys()]
+
+    def update(self, mapping):
+        ''' Set every path in mapping, which may be a dict or an
+        iterable of (path, data) pairs.
+
+        Paths are grouped by parent so each parent is walked once, and
+        the subtree counts along that walk are adjusted once per group
+        rather than once per path.
+        '''
+
+        with self.lock:
+            if hasattr(mapping, 'iteritems'):
+                mapping = mapping.iteritems()
+
+            groups = {}
+            for path, value in mapping:
+                head, _, name = path.rpartition('/')
+                if not name:
+                    self._set(_split(path), value)
+                    continue
+                groups.setdefault(head, []).append((name, value))
+
+            for head, children in groups.iteritems():
+                elements = _split(head)
+                nodes = self._make_nodes(elements)
+                prefix = _join(elements + [''])
+                d = nodes[-1]
+                added = 0
+                for name, value in children:
+                    n = d.children.get(name)
+                    if n is None or n.gen != self.gen:
+                        n = d.child(name)
+                    if self.index and n.has_data():
+                        self._remove_index(prefix + name, n.data)
+                    data = _NO_DATA if value is None else value
+                    delta = (data is not _NO_DATA) - n.has_data()
+                    n.count += delta
+                    added += delta
+                    n.data = data
+                    if self.index:
+                        self._add_index(prefix + name, value)
+
+                for n in nodes:
+                    n.count += added
+
+    def prune(self, subtree):
+        ''' Detach subtree and everything below it in one operation,
+        along with any ancestors left without data or children.
+
+        Returns the number of data-carrying paths removed; a missing
+        subtree removes nothing.
+        '''
+
+        with self.lock:
+            elements = _split(subtree)
+            if not elements:
+                removed = self.root.count
+                self.root = PathTreeNode(self.gen)
+                self.indexed.clear()
+                return removed
+
+            try:
+                self._walk(elements)
+            except KeyError:
+                return 0
+
+            nodes = self._make_nodes(elements[:-1])
+            node = nodes[-1].children[elements[-1]]
+            removed = node.count
+
+            if self.index:
+                path = _join(elements)
+                self._remove_index(path, node.data)
+                for k, v in self.iterdataitems(path):
+                    self._remove_index(k, v)
+
+            nodes[-1].remove_child(elements[-1])
+            for n in nodes:
+                n.count -= removed
+
+            for i in range(len(nodes) - 1, 0, -1):
+                if nodes[i].has_data() or nodes[i].children:
+                    break
+                nodes[i - 1].remove_child(elements[i - 1])
+
+            return removed
 
     def demote(self, key):
-        n = self._get_node(key)
-        if 'data' in n:
-            del n['data']
+        with self.lock:
+            try:
+                nodes = self._own_nodes(_split(key))
+            except KeyError:
+                raise KeyError(key)
+
+            if nodes[-1].has_data():
+                for n in nodes:
+                    n.count -= 1
+                if self.index:
+                    self._remove_index(_join(_split(key)), nodes[-1].data)
+            nodes[-1].data = _NO_DATA
+
+    def snapshot(self):
+        ''' Return a read-only PathTreeSnapshot of the current tree in
+        O(1).
+
+        The snapshot shares every node with this tree.  Later writes
+        copy the nodes along the path they modify instead of changing
+        them in place, so the snapshot can be read, from any thread,
+        while the tree keeps changing.  Snapshots are not indexed.
+        '''
+
+        with self.lock:
+            snap = PathTreeSnapshot(self.root)
+            self.gen += 1
+        return snap
+
+    def count(self, subtree='/'):
+        ''' Return the number of paths below subtree that carry data,
+        without walking them.
+        '''
+
+        n = self._get_node(subtree)
+        return n.count - 1 if n.has_data() else n.count
 
     def keys(self, subtree='/', depth=None):
         return [x for x in self.iterkeys(subtree, depth)]
@@ -169,18 +530,123 @@ class PathTree:
         return [x for x in self.iteritems(subtree, depth)]
 
     def dataitems(self, subtree='/', depth=None):
-        return [x for x in self.iteritems(subtree, depth)
-                if x[1] is not None]
+        return [x for x in self.iterdataitems(subtree, depth)]
 
-    def iterkeys(self, subtree='/', depth=None):
-        if not self.root:
+    def iterkeys(self, subtree='/', depth=None, **kw):
+        if not self.root.children:
             return {}.iterkeys()
-        return PathTreeKeyIterator(self, subtree, depth)
+        return PathTreeKeyIterator(self, subtree, depth, **kw)
 
-    def iteritems(self, subtree='/', depth=None):
-        if not self.root:
+    def iteritems(self, subtree='/', depth=None, **kw):
+        if not self.root.children:
             return {}.iteritems()
-        return PathTreeItemIterator(self, subtree, depth)
+        return PathTreeItemIterator(self, subtree, depth, **kw)
+
+    def iterdataitems(self, subtree='/', depth=None, **kw):
+        return self.iteritems(subtree, depth, data_only=True, **kw)
+
+    def itersorted(self, subtree='/', after=None):
+        ''' Iterate over the (path, data) items below subtree that carry
+        data, in path order, starting after the path after.
+
+        Children are sorted as they are visited, and those whose
+        subtrees sort entirely at or before after are skipped without
+        being walked, so stopping early costs only the items taken.
+        '''
+
+        elements = _split(subtree)
+        try:
+            node = self._walk(elements)
+        except KeyError:
+            raise KeyError(subtree)
+
+        prefix = '/' + '/'.join(elements) + '/' if elements else '/'
+        stack = [self._sorted_children(node, prefix, after)]
+        while stack:
+            for path, child in stack[-1]:
+                data = child.get_data()
+                if data is not None and (after is None or path > after):
+                    yield path, data
+                if child.children:
+                    stack.append(
+                        self._sorted_children(child, path + '/', after))
+                    break
+            else:
+                stack.pop()
+
+    @staticmethod
+    def _sorted_children(node, prefix, after):
+        names = sorted(node.children)
+        if after is not None and after.startswith(prefix):
+            ## object path elements sort after '/', so every child
+            ## before the one leading to after sorts before it
+            element = after[len(prefix):].split('/', 1)[0]
+            names = names[bisect.bisect_left(names, element):]
+        children = node.children
+        return ((prefix + name, children[name]) for name in names)
+
+    def iterglob(self, pattern, data_only=True):
+        ''' Iterate over the (path, data) items matching pattern.
+
+        A '*' or '?' matches within a single path element and a '**'
+        element matches zero or more elements.  Literal elements are
+        looked up directly, so branches that cannot match are never
+        visited.
+        '''
+
+        pattern = _split(pattern)
+        regexes = [None if e == '**' or not _has_magic(e)
+                   else re.compile(_element_regex(e) + '$')
+                   for e in pattern]
+        seen = set() if '**' in pattern else None
+        stack = [(self.root, '/', 0)]
+        while stack:
+            node, prefix, i = stack.pop()
+            if i == len(pattern):
+                if prefix == '/':
+                    continue
+                path = prefix[:-1]
+                if data_only and node.get_data() is None:
+                    continue
+                if seen is not None:
+                    if path in seen:
+                        continue
+                    seen.add(path)
+                yield path, node.get_data()
+                continue
+
+            e = pattern[i]
+            if e == '**':
+                stack.append((node, prefix, i + 1))
+                for name, child in node.children.iteritems():
+                    stack.append((child, prefix + name + '/', i))
+            elif regexes[i] is None:
+                child = node.children.get(e)
+                if child is not None:
+                    stack.append((child, prefix + e + '/', i + 1))
+            else:
+                for name, child in node.children.iteritems():
+                    if regexes[i].match(name):
+                        stack.append((child, prefix + name + '/', i + 1))
+
+    def glob(self, pattern, data_only=True):
+        return [x for x in self.iterglob(pattern, data_only)]
+
+    def iterindexed(self, key, pattern=None):
+        ''' Iterate over the (path, data) items indexed under key,
+        optionally restricted to those matching the glob pattern.
+        '''
+
+        if self.index is None:
+            raise ValueError('PathTree has no index')
+
+        regex = _glob_regex(_split(pattern)) if pattern else None
+        for path in list(self.indexed.get(key, [])):
+            if regex is None or regex.match(path):
+                yield path, self._get_node(path).get_data()
+
+    def indexed_items(self, key, pattern=None):
+        return [x for x in self.iterindexed(key, pattern)]
 
     def dumpd(self, subtree='/'):
         result = {}
@@ -195,3 +661,104 @@ class PathTree:
                 d.update(v)
 
         return result
+
+    def iterjson(self, subtree='/', flat=False):
+        ''' Iterate over chunks of a JSON document describing subtree,
+        without building the intermediate dict.
+
+        By default the document has the same shape as dumpd(subtree);
+        with flat set it is an object mapping each path carrying data
+        to that data.
+        '''
+
+        if flat:
+            return self._iterjson_flat(subtree)
+        return self._iterjson_nested(subtree)
+
+    def _iterjson_flat(self, subtree):
+        out = ['{']
+        first = True
+        for path, data in self.iterdataitems(subtree):
+            if not first:
+                out.append(', ')
+            first = False
+            out.append(_quote(path))
+            out.append(': ')
+            _json_value(data, out)
+            if len(out) >= _JSON_CHUNK:
+                yield ''.join(out)
+                out = []
+
+        out.append('}')
+        yield ''.join(out)
+
+    def _iterjson_nested(self, subtree):
+        node = self.root
+        if node.children:
+            node = self._get_node(subtree)
+        if not node.children:
+            yield '{}'
+            return
+
+        elements = _split(subtree)
+        out = ['{"/": ']
+        for e in elements:
+            out.append('{%s: ' % _quote(e))
+        out.append('{')
+
+        stack = [[node.children.iteritems(), True, _NO_CHILDREN]]
+        while stack:
+            top = stack[-1]
+            for name, child in top[0]:
+                if name in top[2]:
+                    continue
+                if not top[1]:
+                    out.append(', ')
+                top[1] = False
+                out.append(_quote(name))
+                out.append(': {')
+
+                data = child.get_data()
+                if data is None:
+                    data = _NO_CHILDREN
+                first = True
+                for k, v in data.iteritems():
+                    if not first:
+                        out.append(', ')
+                    first = False
+                    out.append(_quote(k))
+                    out.append(': ')
+                    _json_value(v, out)
+
+                stack.append([child.children.iteritems(), not data, data])
+                break
+            else:
+                stack.pop()
+                out.append('}')
+
+            if len(out) >= _JSON_CHUNK:
+                yield ''.join(out)
+                out = []
+
+        out.append('}' * (len(elements) + 1))
+        yield ''.join(out)
+
+
+class PathTreeSnapshot(PathTree):
+    def __init__(self, root):
+        PathTree.__init__(self)
+        self.root = root
+        self.gen = None
+
+    def _read_only(self, *a, **kw):
+        raise TypeError('PathTree snapshots are read-only')
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    setdefault = _read_only
+    update = _read_only
+    prune = _read_only
+    demote = _read_only
+
+    def snapshot(self):
+        return self
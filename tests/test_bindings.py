@@ -0,0 +1,158 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+from obmc.dbuslib.bindings import DbusObjectManager, DbusProperties
+
+IFACE = 'xyz.openbmc_project.Test'
+
+
+class Results(object):
+    def __init__(self):
+        self.replies = []
+        self.errors = []
+
+    def reply(self, value):
+        self.replies.append(value)
+
+    def error(self, e):
+        self.errors.append(e)
+
+
+class DeferredGetterTest(unittest.TestCase):
+    def setUp(self):
+        self.obj = DbusProperties()
+        self.reads = []
+
+    def getter(self, reply, error):
+        self.reads.append((reply, error))
+
+    def test_waiters_share_one_read(self):
+        self.obj.add_getter(IFACE, 'p', self.getter, ttl=10, deferred=True)
+        first = Results()
+        second = Results()
+        self.obj.Get(IFACE, 'p', reply=first.reply, error=first.error)
+        self.obj.GetAll(IFACE, reply=second.reply, error=second.error)
+        self.assertEqual(len(self.reads), 1)
+        self.assertEqual((first.replies, second.replies), ([], []))
+
+        self.reads[0][0](42)
+        self.assertEqual(first.replies, [42])
+        self.assertEqual(second.replies, [{'p': 42}])
+
+        ## a fresh value is answered without another read
+        third = Results()
+        self.obj.Get(IFACE, 'p', reply=third.reply, error=third.error)
+        self.assertEqual(third.replies, [42])
+        self.assertEqual(len(self.reads), 1)
+
+    def test_failed_read_is_shared(self):
+        self.obj.add_getter(IFACE, 'p', self.getter, deferred=True)
+        first = Results()
+        second = Results()
+        self.obj.Get(IFACE, 'p', reply=first.reply, error=first.error)
+        self.obj.Get(IFACE, 'p', reply=second.reply, error=second.error)
+        e = IOError('i2c')
+        self.reads[0][1](e)
+        self.assertEqual(first.errors, [e])
+        self.assertEqual(second.errors, [e])
+
+    def test_getter_raising(self):
+        calls = [0]
+
+        def getter(reply, error):
+            calls[0] += 1
+            if calls[0] == 1:
+                raise IOError('i2c')
+            reply(7)
+
+        self.obj.add_getter(IFACE, 'p', getter, deferred=True)
+        first = Results()
+        self.obj.Get(IFACE, 'p', reply=first.reply, error=first.error)
+        self.assertEqual(first.replies, [])
+        self.assertEqual(len(first.errors), 1)
+        self.assertIsInstance(first.errors[0], IOError)
+
+        ## the failed read does not hold up the next one
+        second = Results()
+        self.obj.Get(IFACE, 'p', reply=second.reply, error=second.error)
+        self.assertEqual((second.replies, second.errors), ([7], []))
+
+    def test_getter_raising_for_python_callers(self):
+        def getter(reply, error):
+            raise IOError('i2c')
+
+        self.obj.add_getter(IFACE, 'p', getter, deferred=True)
+        self.assertRaises(IOError, self.obj.Get, IFACE, 'p')
+        self.assertRaises(IOError, self.obj.Get, IFACE, 'p')
+
+
+class FilteredEnumerationTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = DbusObjectManager()
+        names = ['a', 'ab', 'a_1', 'b', 'B', 'z9', 'x']
+        for i, first in enumerate(names):
+            for j, second in enumerate(names[:i + 1]):
+                self.add('/%s/%s' % (first, second), i + j)
+                self.add('/%s/%s/leaf' % (first, second), i)
+        self.add('/a', 0)
+
+    def add(self, path, n):
+        obj = DbusProperties()
+        obj.properties = {IFACE: {'n': n}}
+        if n % 3 == 0:
+            obj.properties['xyz.openbmc_project.Other'] = {}
+        self.manager.add(path, obj)
+
+    def pages(self, path, interface, limit):
+        cursor = ''
+        pages = []
+        while True:
+            data, cursor = self.manager.GetManagedObjectsFiltered(
+                path, interface, cursor, limit)
+            pages.append(sorted(data))
+            if not cursor:
+                return pages
+            self.assertEqual(cursor, pages[-1][-1])
+
+    def expected(self, path, interface):
+        path = path.rstrip('/') or '/'
+        prefix = path.rstrip('/') + '/'
+        return sorted(
+            p for p, props in self.manager.managed_objects.iteritems()
+            if (p == path or p.startswith(prefix)) and
+            (not interface or interface in props))
+
+    def test_pages_in_path_order(self):
+        for path in ('/', '/a', '/a/', '/ab', '/x/a_1', '/missing'):
+            for interface in ('', IFACE, 'xyz.openbmc_project.Other'):
+                expected = self.expected(path, interface)
+                for limit in (0, 1, 4, len(expected)):
+                    pages = self.pages(path, interface, limit)
+                    self.assertEqual(sum(pages, []), expected)
+                    if limit:
+                        self.assertTrue(
+                            all(len(page) <= limit for page in pages))
+
+    def test_interface_properties_only(self):
+        data, cursor = self.manager.GetManagedObjectsFiltered(
+            '/a', 'xyz.openbmc_project.Other', '', 1)
+        self.assertEqual(data, {'/a': {'xyz.openbmc_project.Other': {}}})
+        self.assertEqual(cursor, '/a')
+
+
+if __name__ == '__main__':
+    unittest.main()
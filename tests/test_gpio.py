@@ -0,0 +1,161 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import obmc.gpio
+from obmc.gpio import Gpio, read_many
+
+
+class Export(object):
+    ''' The export attribute: writing a number creates the line's
+    directory when the file is closed, as the kernel does on write.
+    '''
+
+    def __init__(self, sysfs):
+        self.sysfs = sysfs
+        self.data = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        num = int(self.data)
+        self.sysfs.exported.append(num)
+        self.sysfs.line(num)
+
+    def write(self, data):
+        self.data += data
+
+
+class FakeGpioClass(object):
+    ''' A sysfs GPIO class directory in a temp dir. '''
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp()
+        self.exported = []
+
+    def open(self, path, mode='r'):
+        if path == os.path.join(self.dir, 'export'):
+            return Export(self)
+        return open(path, mode)
+
+    def close(self):
+        shutil.rmtree(self.dir)
+
+    def line(self, num, direction='in', value='0', edge='none',
+             active_low='0'):
+        path = os.path.join(self.dir, 'gpio%d' % num)
+        os.mkdir(path)
+        for name, data in (
+                ('direction', direction), ('value', value),
+                ('edge', edge), ('active_low', active_low)):
+            self.set(num, name, data)
+
+    def set(self, num, name, data):
+        path = os.path.join(self.dir, 'gpio%d' % num, name)
+        with open(path, 'w') as f:
+            f.write(data + '\n')
+        ## an attribute that is written again gets a new mtime
+        os.utime(path, (0, 0))
+
+    def get(self, num, name):
+        with open(os.path.join(self.dir, 'gpio%d' % num, name)) as f:
+            return f.read().strip()
+
+    def written(self, num, name):
+        path = os.path.join(self.dir, 'gpio%d' % num, name)
+        return os.stat(path).st_mtime != 0
+
+
+class GpioTest(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = FakeGpioClass()
+        self.gpios = []
+        obmc.gpio.open = self.sysfs.open
+
+    def tearDown(self):
+        del obmc.gpio.open
+        for gpio in self.gpios:
+            gpio.close()
+        self.sysfs.close()
+
+    def gpio(self, num, **kw):
+        gpio = Gpio(num, gpio_dev=self.sysfs.dir, **kw)
+        self.gpios.append(gpio)
+        return gpio
+
+    def test_export_when_missing(self):
+        gpio = self.gpio(7, direction='in')
+        self.assertEqual(self.sysfs.exported, [7])
+        self.assertFalse(gpio.output)
+
+        ## an exported line is not exported again
+        self.gpio(7, direction='in')
+        self.assertEqual(self.sysfs.exported, [7])
+
+    def test_attributes_written_only_on_change(self):
+        self.sysfs.line(1, direction='in', edge='both')
+        self.gpio(1, direction='in', edge='both', active_low=False)
+        for name in ('direction', 'edge', 'active_low', 'value'):
+            self.assertFalse(self.sysfs.written(1, name), name)
+
+        self.gpio(1, direction='out', edge='none', active_low=True)
+        self.assertEqual(self.sysfs.get(1, 'direction'), 'out')
+        self.assertEqual(self.sysfs.get(1, 'edge'), 'none')
+        self.assertEqual(self.sysfs.get(1, 'active_low'), '1')
+        self.assertFalse(self.sysfs.written(1, 'value'))
+
+    def test_high_low_on_existing_output(self):
+        self.sysfs.line(2, direction='out', value='0')
+        gpio = self.gpio(2, direction='high')
+        self.assertTrue(gpio.output)
+        self.assertEqual(self.sysfs.get(2, 'direction'), 'out')
+        self.assertFalse(self.sysfs.written(2, 'direction'))
+        self.assertEqual(self.sysfs.get(2, 'value'), '1')
+
+        self.sysfs.set(2, 'value', '1')
+        self.gpio(2, direction='high')
+        self.assertFalse(self.sysfs.written(2, 'value'))
+        self.gpio(2, direction='low')
+        self.assertEqual(self.sysfs.get(2, 'value'), '0')
+
+    def test_high_on_input(self):
+        self.sysfs.line(3, direction='in')
+        gpio = self.gpio(3, direction='high')
+        self.assertTrue(gpio.output)
+        self.assertEqual(self.sysfs.get(3, 'direction'), 'high')
+
+    def test_read_write_and_read_many(self):
+        for num, value in enumerate('1001'):
+            self.sysfs.line(
+                10 + num, direction='out' if num == 0 else 'in',
+                value=value)
+        gpios = [self.gpio(10 + num) for num in range(4)]
+        self.assertEqual(read_many(gpios), [1, 0, 0, 1])
+        self.assertEqual(read_many([]), [])
+
+        gpios[0].write(0)
+        self.assertEqual(gpios[0].read(), 0)
+        self.sysfs.set(12, 'value', '1')
+        self.assertEqual(read_many(gpios), [0, 0, 1, 1])
+        self.assertEqual([g.read() for g in gpios], [0, 0, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import os
+import time
+import unittest
+import xml.etree.ElementTree as ET
+import xml.parsers.expat as expat
+import dbus
+from obmc.dbuslib.introspection import IntrospectionNodeParser, \
+    IntrospectionParser, LazyIntrospectionNodeParser
+
+
+class FakeProxy(object):
+    def __init__(self, documents, path):
+        self.documents = documents
+        self.path = path
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        return getattr(self, member)
+
+    def Introspect(self, dbus_interface=None):
+        data = self.documents.get(self.path)
+        if data is None:
+            raise dbus.DBusException('unknown object')
+        return data
+
+
+class FakeBus(object):
+    ''' Serves a fixed Introspect document for each path. '''
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def get_object(self, name, path, introspect=True):
+        return FakeProxy(self.documents, path)
+
+
+def node(interfaces=(), children=()):
+    return ''.join(
+        ['<node>'] +
+        ['<interface name="%s"/>' % i for i in interfaces] +
+        ['<node name="%s"/>' % c for c in children] +
+        ['</node>'])
+
+
+class IntrospectionErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = FakeBus({
+            '/': node(children=['a', 'b', 'c']),
+            '/a': node(['org.openbmc.A']),
+            '/b': '<node><interface name="org.openbmc.B"></node>',
+        })
+
+    def test_errors_are_recorded_per_path(self):
+        parser = IntrospectionParser('org.openbmc.Test', self.bus)
+        items = parser.introspect()
+        self.assertEqual(
+            items, {'/a': {'interfaces': ['org.openbmc.A']}})
+        self.assertEqual(sorted(parser.errors), ['/b', '/c'])
+        self.assertIsInstance(parser.errors['/b'], expat.ExpatError)
+        self.assertIsInstance(parser.errors['/c'], dbus.DBusException)
+
+    def test_malformed_root(self):
+        self.bus.documents['/'] = '<node'
+        parser = IntrospectionParser('org.openbmc.Test', self.bus)
+        self.assertEqual(parser.introspect(), {})
+        self.assertEqual(list(parser.errors), ['/'])
+
+        ## a new crawl clears the errors of the last one
+        self.bus.documents['/'] = node(children=['a'])
+        parser.introspect()
+        self.assertEqual(parser.errors, {})
+
+
+def interface(name, members=10):
+    args = ''.join(
+        '<arg name="a%d" type="s" direction="in"/>' % i for i in range(3))
+    return ''.join(
+        ['<interface name="%s">' % name] +
+        ['<method name="M%d">%s</method>' % (i, args)
+         for i in range(members)] +
+        ['<signal name="S%d">%s</signal>' % (i, args) for i in range(3)] +
+        ['<property name="P%d" type="s" access="read"/>' % i
+         for i in range(members)] +
+        ['</interface>'])
+
+
+@unittest.skipUnless(
+    os.environ.get('OBMC_BENCHMARK'), 'set OBMC_BENCHMARK to run')
+class IntrospectionBenchmark(unittest.TestCase):
+    def test_lazy_parse_benchmark(self):
+        xml = ''.join(
+            ['<node>'] +
+            [interface('org.openbmc.I%d' % i) for i in range(6)] +
+            ['<node name="n%d"/>' % i for i in range(3000)] +
+            ['</node>'])
+
+        ## what a crawl asks of each node
+        def crawl(parser):
+            return parser.get_interface_names(), parser.get_children()
+
+        def best(f, count=20):
+            times = []
+            for n in range(5):
+                start = time.time()
+                for x in range(count):
+                    f()
+                times.append(time.time() - start)
+            return min(times)
+
+        tree = best(lambda: crawl(
+            IntrospectionNodeParser(ET.fromstring(xml))))
+        lazy = best(lambda: crawl(LazyIntrospectionNodeParser(xml)))
+        self.assertEqual(
+            sorted(crawl(LazyIntrospectionNodeParser(xml))[0]),
+            sorted(IntrospectionNodeParser(
+                ET.fromstring(xml)).get_interfaces()))
+        print '\nElementTree %.3fs, lazy %.3fs (20 parses, %d bytes)' % (
+            tree, lazy, len(xml))
+        self.assertLess(lazy, tree)
+
+
+if __name__ == '__main__':
+    unittest.main()
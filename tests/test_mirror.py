@@ -0,0 +1,391 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+import dbus
+import dbus.lowlevel
+import gobject
+import obmc.dbuslib.mirror
+from obmc.dbuslib.enums import DBUS_OBJMGR_IFACE
+from obmc.dbuslib.mirror import ObjectMirror
+from obmc.dbuslib.signals import SignalDispatcher
+
+SENSOR_IFACE = 'xyz.openbmc_project.Sensor.Value'
+ITEM_IFACE = 'xyz.openbmc_project.Inventory.Item'
+
+
+class FakeMessage(object):
+    def __init__(self, sender, path, interface, member, args):
+        self.sender = sender
+        self.path = path
+        self.interface = interface
+        self.member = member
+        self.args = args
+
+    def get_type(self):
+        return dbus.lowlevel.MESSAGE_TYPE_SIGNAL
+
+    def get_sender(self):
+        return self.sender
+
+    def get_path(self):
+        return self.path
+
+    def get_interface(self):
+        return self.interface
+
+    def get_member(self):
+        return self.member
+
+    def get_args_list(self):
+        return list(self.args)
+
+
+class FakeService(object):
+    def __init__(self, unique_name, objects, object_manager=True):
+        self.unique_name = unique_name
+        self.objects = objects
+        self.object_manager = object_manager
+
+
+class FakeProxy(object):
+    ''' The part of dbus.proxies.ProxyObject ObjectMirror uses. '''
+
+    def __init__(self, bus, name, path):
+        self.bus = bus
+        self.name = name
+        self.path = path
+
+    def _service(self):
+        service = self.bus.services.get(self.name)
+        if service is None:
+            raise dbus.DBusException('name has no owner')
+        return service
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        return getattr(self, member)
+
+    def GetManagedObjects(self, dbus_interface=None):
+        service = self._service()
+        if not service.object_manager:
+            raise dbus.DBusException('unknown method')
+        return dict(
+            (k, dict((i, dict(p)) for i, p in v.iteritems()))
+            for k, v in service.objects.iteritems())
+
+    def GetAll(self, interface, dbus_interface=None):
+        return dict(self._service().objects[self.path][interface])
+
+    def Get(self, interface, name, dbus_interface=None,
+            reply_handler=None, error_handler=None):
+        value = self._service().objects[self.path][interface][name]
+        self.bus.calls.append((self.path, interface, name))
+        reply_handler(value)
+
+    def Introspect(self, dbus_interface=None):
+        objects = self._service().objects
+        prefix = self.path.rstrip('/') + '/'
+        children = set(
+            k[len(prefix):].split('/')[0] for k in objects
+            if k.startswith(prefix))
+        xml = ['<node>']
+        xml.extend(
+            '<interface name="%s"/>' % i
+            for i in objects.get(self.path, {}))
+        xml.extend('<node name="%s"/>' % c for c in sorted(children))
+        xml.append('</node>')
+        return ''.join(xml)
+
+
+class FakeBus(object):
+    ''' A private stand-in for the bus daemon.  Signals are delivered
+    through the message filters connections install, as dbus-python
+    does.
+    '''
+
+    def __init__(self):
+        self.filters = []
+        self.rules = []
+        self.services = {}
+        self.calls = []
+        self.next_id = 1
+
+    def add_message_filter(self, callback):
+        self.filters.append(callback)
+
+    def add_match_string_non_blocking(self, rule):
+        self.rules.append(rule)
+
+    def remove_match_string_non_blocking(self, rule):
+        self.rules.remove(rule)
+
+    def get_name_owner(self, name):
+        service = self.services.get(name)
+        if service is None:
+            raise dbus.DBusException('name has no owner')
+        return service.unique_name
+
+    def get_object(self, name, path, introspect=True):
+        return FakeProxy(self, name, path)
+
+    def emit(self, sender, path, interface, member, *args):
+        message = FakeMessage(sender, path, interface, member, args)
+        for f in self.filters:
+            f(self, message)
+
+    def start(self, name, objects, object_manager=True):
+        unique_name = ':1.%d' % self.next_id
+        self.next_id += 1
+        self.services[name] = FakeService(
+            unique_name, objects, object_manager)
+        self.emit(
+            dbus.BUS_DAEMON_NAME, dbus.BUS_DAEMON_PATH,
+            dbus.BUS_DAEMON_IFACE, 'NameOwnerChanged',
+            name, '', unique_name)
+        return unique_name
+
+    def stop(self, name):
+        service = self.services.pop(name)
+        self.emit(
+            dbus.BUS_DAEMON_NAME, dbus.BUS_DAEMON_PATH,
+            dbus.BUS_DAEMON_IFACE, 'NameOwnerChanged',
+            name, service.unique_name, '')
+
+
+class FakeMainLoop(object):
+    ''' The idle sources of the GLib main loop, run on demand. '''
+
+    def __init__(self):
+        self.sources = {}
+        self.next_id = 1
+
+    def idle_add(self, callback, *args):
+        source = self.next_id
+        self.next_id += 1
+        self.sources[source] = (callback, args)
+        return source
+
+    def source_remove(self, source):
+        del self.sources[source]
+
+    def run_idle(self):
+        while self.sources:
+            source = min(self.sources)
+            callback, args = self.sources[source]
+            if not callback(*args):
+                self.sources.pop(source, None)
+
+
+def sensors():
+    return {
+        '/xyz/sensors/temp/t0': {SENSOR_IFACE: {'Value': 30, 'Scale': 0}},
+        '/xyz/sensors/temp/t1': {SENSOR_IFACE: {'Value': 31, 'Scale': 0}},
+        '/other/thing': {ITEM_IFACE: {'Present': True}},
+    }
+
+
+class SignalDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = FakeBus()
+        self.dispatcher = SignalDispatcher(self.bus)
+        self.received = []
+
+    def callback(self, *args, **kw):
+        self.received.append((args, kw))
+
+    def test_sender_and_arg0(self):
+        self.dispatcher.add(
+            self.callback, 'NameOwnerChanged', dbus.BUS_DAEMON_IFACE,
+            sender=dbus.BUS_DAEMON_NAME, arg0='xyz.A')
+        self.dispatcher.add(
+            self.callback, 'Changed', 'xyz.I', '/a', sender=':1.7',
+            path_keyword='path')
+        self.assertEqual(self.bus.rules, [
+            "type='signal',sender='%s',interface='%s',"
+            "member='NameOwnerChanged',arg0='xyz.A'" % (
+                dbus.BUS_DAEMON_NAME, dbus.BUS_DAEMON_IFACE),
+            "type='signal',sender=':1.7',interface='xyz.I',"
+            "member='Changed',path_namespace='/a'"])
+
+        self.bus.start('xyz.B', {})
+        self.bus.emit(':1.7', '/a', 'xyz.I', 'Changed', 1)
+        self.bus.emit(':1.8', '/a', 'xyz.I', 'Changed', 2)
+        self.bus.emit(':1.7', '/b', 'xyz.I', 'Changed', 3)
+        self.bus.start('xyz.A', {})
+        self.bus.emit(
+            ':1.9', dbus.BUS_DAEMON_PATH, dbus.BUS_DAEMON_IFACE,
+            'NameOwnerChanged', 'xyz.A', '', ':1.9')
+        self.assertEqual(self.received, [
+            ((1,), {'path': '/a'}),
+            (('xyz.A', '', ':1.2'), {}),
+        ])
+
+        self.dispatcher.remove(
+            self.callback, 'Changed', 'xyz.I', '/a', sender=':1.7')
+        self.dispatcher.remove(
+            self.callback, 'NameOwnerChanged', dbus.BUS_DAEMON_IFACE,
+            sender=dbus.BUS_DAEMON_NAME, arg0='xyz.A')
+        self.assertEqual(self.bus.rules, [])
+        self.assertEqual(self.dispatcher.members, {})
+
+
+class ObjectMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeMainLoop()
+        obmc.dbuslib.mirror.gobject = self.loop
+        self.bus = FakeBus()
+        self.owner = self.bus.start('xyz.Sensors', sensors())
+        self.mirror = ObjectMirror(self.bus, 'xyz.Sensors', '/xyz')
+
+    def tearDown(self):
+        obmc.dbuslib.mirror.gobject = gobject
+
+    def emit(self, path, interface, member, *args, **kw):
+        sender = kw.get('sender', self.owner)
+        self.bus.emit(sender, path, interface, member, *args)
+
+    def test_seed_from_object_manager(self):
+        self.assertEqual(
+            sorted(k for k, v in self.mirror.get_objects()),
+            ['/xyz/sensors/temp/t0', '/xyz/sensors/temp/t1'])
+        self.assertEqual(
+            self.mirror.get_property(
+                '/xyz/sensors/temp/t1', SENSOR_IFACE, 'Value'), 31)
+        self.assertNotIn('/other/thing', self.mirror)
+
+    def test_seed_by_crawl(self):
+        self.bus.start('xyz.Crawled', sensors(), object_manager=False)
+        mirror = ObjectMirror(self.bus, 'xyz.Crawled', '/xyz')
+        self.assertEqual(
+            sorted(k for k, v in mirror.get_objects()),
+            ['/xyz/sensors/temp/t0', '/xyz/sensors/temp/t1'])
+        self.assertEqual(
+            mirror.get_property(
+                '/xyz/sensors/temp/t0', SENSOR_IFACE, 'Value'), 30)
+
+    def test_interfaces_added_and_removed(self):
+        path = '/xyz/sensors/temp/t2'
+        self.emit(
+            '/', DBUS_OBJMGR_IFACE, 'InterfacesAdded',
+            path, {SENSOR_IFACE: {'Value': 40}})
+        self.emit(
+            '/', DBUS_OBJMGR_IFACE, 'InterfacesAdded',
+            '/other/new', {ITEM_IFACE: {}})
+        self.assertEqual(
+            self.mirror.get_property(path, SENSOR_IFACE, 'Value'), 40)
+        self.assertNotIn('/other/new', self.mirror)
+        self.assertEqual(
+            sorted(k for k, v in self.mirror.get_implementing(
+                SENSOR_IFACE)),
+            ['/xyz/sensors/temp/t0', '/xyz/sensors/temp/t1', path])
+
+        self.emit(
+            '/', DBUS_OBJMGR_IFACE, 'InterfacesRemoved',
+            path, [SENSOR_IFACE])
+        self.assertNotIn(path, self.mirror)
+        self.assertEqual(len(self.mirror.get_objects()), 2)
+
+    def test_properties_changed(self):
+        path = '/xyz/sensors/temp/t0'
+        snapshot = self.mirror.tree.snapshot()
+        self.emit(
+            path, dbus.PROPERTIES_IFACE, 'PropertiesChanged',
+            SENSOR_IFACE, {'Value': 35}, [])
+        self.assertEqual(
+            self.mirror.get_property(path, SENSOR_IFACE, 'Value'), 35)
+        self.assertEqual(snapshot[path][SENSOR_IFACE]['Value'], 30)
+
+    def test_invalidated_properties_are_read_again(self):
+        path = '/xyz/sensors/temp/t0'
+        self.bus.services['xyz.Sensors'].objects[path][SENSOR_IFACE][
+            'Scale'] = -3
+        self.emit(
+            path, dbus.PROPERTIES_IFACE, 'PropertiesChanged',
+            SENSOR_IFACE, {}, ['Scale'])
+        self.assertEqual(self.bus.calls, [(path, SENSOR_IFACE, 'Scale')])
+        self.assertEqual(
+            self.mirror.get_property(path, SENSOR_IFACE, 'Scale'), -3)
+
+    def test_signals_from_other_connections_are_ignored(self):
+        path = '/xyz/sensors/temp/t0'
+        self.emit(
+            path, dbus.PROPERTIES_IFACE, 'PropertiesChanged',
+            SENSOR_IFACE, {'Value': 99}, [], sender=':1.999')
+        self.emit(
+            '/', DBUS_OBJMGR_IFACE, 'InterfacesRemoved',
+            path, [SENSOR_IFACE], sender=':1.999')
+        self.assertEqual(
+            self.mirror.get_property(path, SENSOR_IFACE, 'Value'), 30)
+
+    def test_service_restart(self):
+        path = '/xyz/sensors/temp/t0'
+        self.emit(
+            path, dbus.PROPERTIES_IFACE, 'PropertiesChanged',
+            SENSOR_IFACE, {'Value': 35}, [])
+
+        self.bus.stop('xyz.Sensors')
+        self.assertEqual(self.mirror.get_objects(), [])
+        self.assertIsNone(self.mirror.owner)
+
+        objects = sensors()
+        del objects['/xyz/sensors/temp/t1']
+        objects[path][SENSOR_IFACE]['Value'] = 50
+        old_owner = self.owner
+        self.owner = self.bus.start('xyz.Sensors', objects)
+        self.assertEqual(self.mirror.owner, self.owner)
+
+        ## the service is not called from inside the signal handler
+        self.assertEqual(self.mirror.get_objects(), [])
+        self.loop.run_idle()
+        self.assertEqual(
+            [k for k, v in self.mirror.get_objects()], [path])
+        self.assertEqual(
+            self.mirror.get_property(path, SENSOR_IFACE, 'Value'), 50)
+
+        ## late signals from the old instance are dropped
+        self.emit(
+            path, dbus.PROPERTIES_IFACE, 'PropertiesChanged',
+            SENSOR_IFACE, {'Value': 1}, [], sender=old_owner)
+        self.assertEqual(
+            self.mirror.get_property(path, SENSOR_IFACE, 'Value'), 50)
+
+    def test_other_names_are_ignored(self):
+        self.assertIn("arg0='xyz.Sensors'", ' '.join(self.bus.rules))
+        self.bus.start('xyz.Other', sensors())
+        self.bus.stop('xyz.Other')
+        self.assertEqual(self.mirror.owner, self.owner)
+        self.assertEqual(self.loop.sources, {})
+        self.assertEqual(len(self.mirror.get_objects()), 2)
+
+    def test_rules_follow_the_owner(self):
+        self.assertIn("sender='%s'" % self.owner, ' '.join(self.bus.rules))
+        self.bus.stop('xyz.Sensors')
+        self.assertNotIn(self.owner, ' '.join(self.bus.rules))
+        owner = self.bus.start('xyz.Sensors', sensors())
+        self.assertIn("sender='%s'" % owner, ' '.join(self.bus.rules))
+
+    def test_close_removes_match_rules(self):
+        self.bus.stop('xyz.Sensors')
+        self.owner = self.bus.start('xyz.Sensors', sensors())
+        self.assertTrue(self.bus.rules)
+        self.assertTrue(self.loop.sources)
+        self.mirror.close()
+        self.assertEqual(self.bus.rules, [])
+        self.assertEqual(self.loop.sources, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
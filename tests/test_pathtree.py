@@ -0,0 +1,294 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import copy
+import os
+import sys
+import threading
+import time
+import unittest
+from obmc.utils.pathtree import PathTree
+
+
+def best(f, count=1):
+    ''' The best time of five runs of count calls to f. '''
+
+    times = []
+    for n in range(5):
+        start = time.time()
+        for x in range(count):
+            f()
+        times.append(time.time() - start)
+    return min(times)
+
+
+class PathTreeUnicodeTest(unittest.TestCase):
+    def test_unicode_paths(self):
+        tree = PathTree()
+        tree[u'/a/b'] = 1
+        tree.update({u'/x/y': 2, '/x/z': 3})
+        tree['/a/c'] = 4
+
+        self.assertEqual(tree['/a/b'], 1)
+        self.assertEqual(tree[u'/x/y'], 2)
+        self.assertEqual(len(tree), 4)
+        self.assertEqual(
+            sorted(tree.dataitems()),
+            [('/a/b', 1), ('/a/c', 4), ('/x/y', 2), ('/x/z', 3)])
+
+        tree.prune(u'/x')
+        self.assertEqual(len(tree), 2)
+
+
+class PathTreeNoneTest(unittest.TestCase):
+    def check(self, tree, expected):
+        paths = sorted(p for p, _ in tree.dataitems())
+        self.assertEqual(paths, expected)
+        self.assertEqual(len(tree), len(expected))
+        self.assertEqual(tree.count(), len(expected))
+        self.assertEqual(
+            [p for p in ('/a', '/a/b', '/a/c', '/d') if p in tree], expected)
+        self.assertEqual(tree.count('/a'), len(
+            [p for p in expected if p.startswith('/a/')]))
+
+    def test_none_is_not_data(self):
+        for update in (False, True):
+            tree = PathTree(index=lambda data: data.keys())
+            items = [('/a', {'x': 1}), ('/a/b', None), ('/a/c', {'x': 2}),
+                     ('/d', None)]
+            if update:
+                tree.update(items)
+            else:
+                for path, data in items:
+                    tree[path] = data
+            self.check(tree, ['/a', '/a/c'])
+            self.assertEqual(sorted(tree.get_children('/a')), ['b', 'c'])
+            self.assertIsNone(tree['/a/b'])
+
+            ## None over data removes it, and data over None adds it
+            tree['/a'] = None
+            tree.update([('/a/c', None), ('/a/b', {'x': 3})])
+            self.check(tree, ['/a/b'])
+            self.assertEqual(tree.indexed, {'x': set(['/a/b'])})
+            tree['/d'] = {'y': 1}
+            self.check(tree, ['/a/b', '/d'])
+
+
+class PathTreeSortedTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = PathTree()
+        for path in ('/a/b', '/a/b/c', '/ab', '/a_b/c', '/a/ba', '/b',
+                     '/A/x', '/a/b/c/d', '/a/c/d'):
+            self.tree[path] = {'path': path}
+
+    def test_sorted_order(self):
+        expected = sorted(p for p, _ in self.tree.dataitems())
+        self.assertEqual(
+            [p for p, _ in self.tree.itersorted()], expected)
+        self.assertEqual(
+            [p for p, _ in self.tree.itersorted('/a')],
+            [p for p in expected if p.startswith('/a/')])
+
+    def test_after(self):
+        paths = sorted(p for p, _ in self.tree.dataitems())
+        for after in paths + ['/', '/a', '/a/b/b', '/a/bb', '/zz']:
+            self.assertEqual(
+                [p for p, _ in self.tree.itersorted(after=after)],
+                [p for p in paths if p > after], after)
+
+    def test_missing_subtree(self):
+        self.assertRaises(KeyError, list, self.tree.itersorted('/c'))
+
+
+class PathTreeSnapshotTest(unittest.TestCase):
+    def test_snapshots_while_writing(self):
+        tree = PathTree()
+        tree.update(('/a/%d/%d' % (i, j), j) for i in range(10)
+                    for j in range(10))
+        stop = threading.Event()
+        failures = []
+
+        def writer(n):
+            i = 0
+            while not stop.is_set():
+                i += 1
+                base = '/a/%d' % ((n + i) % 10)
+                tree[base + '/x'] = i
+                tree.update({base + '/y': i, base + '/z/%d' % n: i})
+                if i % 3 == 0:
+                    tree.prune(base + '/z')
+                if i % 5 == 0:
+                    tree.demote(base + '/y')
+
+        def reader():
+            taken = []
+            while not stop.is_set():
+                snap = tree.snapshot()
+                items = snap.dataitems()
+                if len(snap) != len(items):
+                    failures.append((len(snap), len(items)))
+                taken.append((snap, sorted(items)))
+            ## every snapshot still holds what it held when it was read
+            for snap, items in taken:
+                if sorted(snap.dataitems()) != items:
+                    failures.append(items)
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in range(3)]
+        threads.extend(threading.Thread(target=reader) for n in range(3))
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        stop.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(failures, [])
+
+    @unittest.skipUnless(
+        os.environ.get('OBMC_BENCHMARK'), 'set OBMC_BENCHMARK to run')
+    def test_snapshot_benchmark(self):
+        tree = PathTree()
+        for i in range(2000):
+            tree['/xyz/sensors/%d/value' % i] = {
+                'Value': i, 'Unit': 'C', 'Scale': 0}
+        snapshot = best(tree.snapshot, 5)
+        deepcopy = best(lambda: copy.deepcopy(tree), 5)
+        print '\nsnapshot %.4fs, deepcopy %.4fs (5 copies, 2000 objects)' \
+            % (snapshot, deepcopy)
+        self.assertLess(snapshot, deepcopy)
+
+
+def inventory(n):
+    ''' n paths five elements deep, 100 to a parent. '''
+
+    return [('/xyz/inventory/c%d/b%d/i%d' % (i / 1000, i / 100 % 10, i % 100),
+             {'Present': True, 'Index': i}) for i in range(n)]
+
+
+class RecursiveItemIterator(object):
+    ''' The walk PathTreeItemIterator replaced, which recursed once per
+    exhausted level and joined every path from its elements.
+    '''
+
+    def __init__(self, tree):
+        self.path = []
+        self.itlist = []
+        self.it = tree.root.children.iteritems()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        key, value = self._next()
+        return '/' + '/'.join(self.path), value.get_data()
+
+    def _next(self):
+        try:
+            x = self.it.next()
+            self.itlist.append(self.it)
+            self.path.append(x[0])
+            self.it = x[1].children.iteritems()
+        except StopIteration:
+            if not self.itlist:
+                raise StopIteration
+
+            self.it = self.itlist.pop()
+            self.path.pop()
+            x = self._next()
+
+        return x
+
+
+@unittest.skipUnless(
+    os.environ.get('OBMC_BENCHMARK'), 'set OBMC_BENCHMARK to run')
+class PathTreeBenchmark(unittest.TestCase):
+    def test_walk_benchmark(self):
+        print
+        for n in (10000, 100000):
+            tree = PathTree()
+            tree.update(inventory(n))
+            walks = [
+                ('recursive', lambda: sum(
+                    1 for x in RecursiveItemIterator(tree))),
+                ('depth first', lambda: sum(1 for x in tree.iteritems())),
+                ('breadth first', lambda: sum(1 for x in tree.iteritems(
+                    order='breadth'))),
+                ('data only', lambda: sum(
+                    1 for x in tree.iterdataitems())),
+            ]
+            times = {}
+            for name, walk in walks:
+                times[name] = best(walk)
+                print '%d paths, %s: %.0f items/s' % (
+                    n, name, walk() / times[name])
+            self.assertLess(times['depth first'], times['recursive'])
+
+    def test_node_benchmark(self):
+        ## the layout PathTreeNode replaced: a dict per element holding
+        ## a children dict and an optional data key
+        def dict_set(root, path, data):
+            d = root
+            for k in path.split('/')[1:]:
+                d = d['children'].setdefault(k, {'children': {}})
+            d['data'] = data
+
+        def dict_get(root, path):
+            d = root
+            for k in path.split('/')[1:]:
+                d = d['children'][k]
+            return d.get('data')
+
+        def dict_size(d):
+            return sys.getsizeof(d) + sys.getsizeof(d['children']) + sum(
+                dict_size(c) for c in d['children'].itervalues())
+
+        def node_size(n):
+            size = sys.getsizeof(n)
+            if n.children:
+                size += sys.getsizeof(n.children)
+            return size + sum(
+                node_size(c) for c in n.children.itervalues())
+
+        items = inventory(50000)
+        paths = [p for p, data in items]
+        tree = PathTree()
+        root = {'children': {}}
+
+        def tree_set():
+            for p, data in items:
+                tree[p] = data
+
+        def root_set():
+            for p, data in items:
+                dict_set(root, p, data)
+
+        times = [
+            best(tree_set), best(root_set),
+            best(lambda: [tree[p] for p in paths]),
+            best(lambda: [dict_get(root, p) for p in paths]),
+        ]
+        nodes = node_size(tree.root)
+        dicts = dict_size(root)
+        print '\nnodes %.1f MiB, set %.3fs, get %.3fs' % (
+            nodes / 1048576.0, times[0], times[2])
+        print 'dicts %.1f MiB, set %.3fs, get %.3fs (50000 paths)' % (
+            dicts / 1048576.0, times[1], times[3])
+        self.assertLess(nodes, dicts)
+
+
+if __name__ == '__main__':
+    unittest.main()
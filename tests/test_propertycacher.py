@@ -0,0 +1,286 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import cPickle
+import cStringIO
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import dbus
+from obmc.dbuslib import propertycacher
+
+SCALARS = [
+    dbus.Byte(200),
+    dbus.Boolean(True),
+    dbus.Int16(-300),
+    dbus.UInt16(60000),
+    dbus.Int32(-70000),
+    dbus.UInt32(4000000000),
+    dbus.Int64(-2 ** 40),
+    dbus.UInt64(2 ** 63),
+    dbus.Double(1.5),
+    dbus.String(u'caf\xe9'),
+    dbus.UTF8String('caf\xc3\xa9'),
+    dbus.ObjectPath('/xyz/openbmc_project'),
+    dbus.Signature('a{sv}'),
+    dbus.ByteArray('\x00\xff'),
+    True,
+    7,
+    2 ** 70,
+    2.5,
+    'bytes\xff',
+    u'text\xe9',
+]
+
+
+def types(o):
+    if isinstance(o, dict):
+        return (type(o), getattr(o, 'signature', None), sorted(
+            (types(k), types(v)) for k, v in o.iteritems()))
+    if isinstance(o, (list, tuple)):
+        return (type(o), getattr(o, 'signature', None),
+                [types(x) for x in o])
+    return type(o)
+
+
+class Evil(object):
+    def __reduce__(self):
+        return (os.system, ('true',))
+
+
+class CodecTest(unittest.TestCase):
+    def assertRoundTrip(self, value):
+        result = propertycacher.decode(propertycacher.encode(value))
+        self.assertEqual(result, value)
+        self.assertEqual(types(result), types(value))
+
+    def test_scalars(self):
+        for value in SCALARS:
+            self.assertRoundTrip(value)
+            self.assertRoundTrip({'p': value})
+            self.assertRoundTrip({value: 'p'})
+
+    def test_property_dict(self):
+        self.assertRoundTrip(dict(
+            ('p%d' % i, v) for i, v in enumerate(SCALARS)))
+        self.assertRoundTrip({})
+
+    def test_containers(self):
+        value = {
+            'Associations': dbus.Array([
+                dbus.Struct(
+                    (dbus.String(u'a'), dbus.String(u'b'),
+                     dbus.ObjectPath('/c')),
+                    signature='sso')],
+                signature='(sso)'),
+            'Map': dbus.Dictionary(
+                {dbus.String(u'k'): dbus.Double(1.5)}, signature='sd'),
+            'Empty': dbus.Array([], signature='s'),
+            'Untyped': dbus.Array([dbus.Int32(1)]),
+            'plain': [1, u'x', None, {'a': [2.0]}],
+            'tuple': (1, (2, 3)),
+            'none': None,
+        }
+        self.assertRoundTrip(value)
+        self.assertRoundTrip(value['Associations'])
+        self.assertRoundTrip([value, None])
+        self.assertRoundTrip(None)
+
+    def test_uncacheable(self):
+        for value in [{'p': object()}, {'p': [set()]}, object()]:
+            self.assertRaises(TypeError, propertycacher.encode, value)
+
+    def test_legacy_pickle(self):
+        props = {u'Value': 42, u'Unit': u'DegreesC', u'Present': True}
+        for protocol in (0, 2):
+            self.assertEqual(
+                propertycacher.decode(cPickle.dumps(props, protocol)),
+                props)
+
+    def test_pickles_calling_functions_are_rejected(self):
+        for protocol in (0, 2):
+            data = cPickle.dumps({'p': Evil()}, protocol)
+            self.assertRaises(ValueError, propertycacher.decode, data)
+            self.assertRaises(
+                ValueError, propertycacher.decode,
+                propertycacher.FORMAT_MAGIC + data)
+        data = cPickle.dumps(('F', 'B*', ['p', Evil()]), 2)
+        self.assertRaises(
+            ValueError, propertycacher.decode,
+            propertycacher.FORMAT_MAGIC + data)
+
+    def test_malformed(self):
+        def entry(value):
+            return propertycacher.FORMAT_MAGIC + cPickle.dumps(value, 2)
+
+        good = propertycacher.encode({'p': dbus.UInt32(1)})
+        for data in [
+                '', 'garbage', good[:-3], good + '.',
+                propertycacher.FORMAT_MAGIC,
+                entry(None), entry(()), entry(('X', 1)),
+                ## unknown codes
+                entry(('F', 'BZ', ['p', 1])),
+                entry(('V', ('Z', 1))),
+                entry(('V', ('a', None, 'Z', [1]))),
+                entry(('V', ('z', None, 'i', [1]))),
+                ## values that do not match their codes
+                entry(('F', 'Bu', ['p', 'x'])),
+                entry(('F', 'Bu', ['p', 1.0])),
+                entry(('F', 'Bi', ['p'])),
+                entry(('F', 'B', ['p'])),
+                entry(('F', 'BB*', ['p', 'q', 1])),
+                entry(('V', ('s', 'not unicode'))),
+                entry(('V', ('o', 'not a path'))),
+                entry(('V', ('e', None, 'BBB', ['a', 'b', 'c']))),
+                entry(('F', 'B', 'p')),
+        ]:
+            self.assertRaises(ValueError, propertycacher.decode, data)
+
+
+def _old_encode(props):
+    ## what save() did before the typed format
+    return cPickle.dumps(json.loads(json.dumps(props)))
+
+
+def _old_decode(data):
+    ## what load() did before the typed format
+    props = {}
+    loaded = cPickle.loads(data)
+    for prop in loaded.keys():
+        props[prop] = loaded[prop]
+    return props
+
+
+def _decode(data):
+    props = {}
+    props.update(propertycacher.decode(data))
+    return props
+
+
+class CodecBenchmark(unittest.TestCase):
+    @unittest.skipUnless(
+        os.environ.get('OBMC_BENCHMARK'), 'set OBMC_BENCHMARK to run')
+    def test_codec_benchmark(self):
+        sensor = {
+            'Value': dbus.Int64(42), 'Scale': dbus.Int32(-3),
+            'Unit': dbus.String(u'DegreesC'),
+            'Present': dbus.Boolean(True), 'Serial': dbus.UInt32(7),
+            'Path': dbus.ObjectPath('/a/b'),
+            'MaxValue': dbus.Int64(100), 'MinValue': dbus.Int64(0),
+        }
+        inventory = dict(sensor, **{
+            'Associations': dbus.Array([
+                dbus.Struct(
+                    (dbus.String(u'chassis'), dbus.String(u'all_sensors'),
+                     dbus.ObjectPath('/xyz/chassis')),
+                    signature='sso')],
+                signature='(sso)'),
+            'Map': dbus.Dictionary(
+                {dbus.String(u'k'): dbus.Double(1.5)}, signature='sd'),
+            'Versions': dbus.Array(
+                [dbus.String(u'v1'), dbus.String(u'v2')], signature='s'),
+        })
+
+        def best(f, arg, count=20000):
+            times = []
+            for n in range(5):
+                start = time.time()
+                for x in xrange(count):
+                    f(arg)
+                times.append(time.time() - start)
+            return min(times)
+
+        print
+        for name, props in [('sensor', sensor), ('inventory', inventory)]:
+            old = (best(_old_encode, props),
+                   best(_old_decode, _old_encode(props)))
+            new = (best(propertycacher.encode, props),
+                   best(_decode, propertycacher.encode(props)))
+            print '%-9s old encode %.3fs decode %.3fs, ' \
+                'new encode %.3fs decode %.3fs (20000 entries)' \
+                % ((name,) + old + new)
+
+
+@unittest.skipUnless(
+    os.environ.get('OBMC_BENCHMARK'), 'set OBMC_BENCHMARK to run')
+class ColdStartBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_path = propertycacher.CACHE_PATH
+        propertycacher.CACHE_PATH = self.dir + '/'
+
+    def tearDown(self):
+        propertycacher.set_backend(propertycacher.FileBackend())
+        propertycacher.CACHE_PATH = self.cache_path
+        shutil.rmtree(self.dir)
+
+    def test_cold_start_benchmark(self):
+        iface = 'xyz.openbmc_project.Sensor.Value'
+        paths = ['/xyz/openbmc_project/sensors/temperature/t%d' % i
+                 for i in range(5000)]
+        items = [((p, iface), propertycacher.encode({
+            'Value': dbus.Int64(i), 'Scale': dbus.Int32(-3),
+            'Unit': dbus.String(u'DegreesC')}))
+            for i, p in enumerate(paths)]
+        db = os.path.join(self.dir, propertycacher.CACHE_DB)
+        propertycacher.FileBackend().write_many(items)
+        propertycacher.SqliteBackend(db).write_many(items)
+
+        def load_each():
+            stdout = sys.stdout
+            sys.stdout = cStringIO.StringIO()
+            try:
+                for p in paths:
+                    propertycacher.load(p, iface, {})
+            finally:
+                sys.stdout = stdout
+
+        def best(f):
+            times = []
+            for n in range(5):
+                start = time.time()
+                f()
+                times.append(time.time() - start)
+            return min(times)
+
+        ## each start opens the backend afresh; the page cache is warm
+        print
+        times = {}
+        for name, backend in [
+                ('files', propertycacher.FileBackend),
+                ('sqlite', lambda: propertycacher.SqliteBackend(db))]:
+            def load_all():
+                propertycacher.set_backend(backend())
+                return propertycacher.load_all()
+
+            def load():
+                propertycacher.set_backend(backend())
+                load_each()
+
+            self.assertEqual(len(load_all()), len(paths))
+            times[name] = best(load_all), best(load)
+            print '%-6s load_all %.3fs, per object load %.3fs ' \
+                '(5000 objects)' % ((name,) + times[name])
+
+        self.assertLess(times['sqlite'][0], times['files'][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
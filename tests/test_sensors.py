@@ -0,0 +1,233 @@
+# Contributors Listed Below - COPYRIGHT 2016
+# [+] International Business Machines Corp.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+import gobject
+import obmc.sensors
+from obmc.dbuslib.bindings import DbusProperties
+from obmc.sensors import Deadband, SensorPoller, SensorValue
+
+
+class Sensor(SensorValue):
+    ## not exported on a bus
+    def __init__(self, path):
+        DbusProperties.__init__(self)
+        SensorValue.__init__(self, None, path)
+        self.unmask_signals()
+        self.values = []
+
+    def setValue(self, value):
+        self.values.append(value)
+        SensorValue.setValue(self, value)
+
+    def error(self):
+        return self.Get(SensorValue.IFACE_NAME, 'error')
+
+
+class FailingSensor(Sensor):
+    def setValue(self, value):
+        raise IOError('bus gone')
+
+
+class SensorPollerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.poller = SensorPoller(slices=4)
+
+    def tearDown(self):
+        self.poller.stop()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def add(self, n, interval=1000, cls=Sensor, **kw):
+        sensor = cls('/sensors/temp%d' % n)
+        path = self.write('temp%d_input' % n, '%d\n' % (30000 + n))
+        self.poller.add(sensor, path, interval, **kw)
+        return sensor
+
+    def test_grouping_and_slicing(self):
+        sensors = [self.add(i) for i in range(10)]
+        fast = self.add(10, interval=500)
+        self.assertEqual(sorted(self.poller.groups), [500, 1000])
+        group = self.poller.groups[1000]
+        self.assertEqual(group.slices, 4)
+        self.assertEqual(self.poller.groups[500].slices, 1)
+
+        ## every sensor is read once over one interval's ticks
+        sizes = []
+        for tick in range(group.slices):
+            reads = self.poller.reads
+            self.poller._poll(group)
+            sizes.append(self.poller.reads - reads)
+        self.assertEqual(sizes, [3, 3, 2, 2])
+        self.assertEqual(
+            [s.values for s in sensors], [[30000 + i] for i in range(10)])
+        self.assertEqual(fast.values, [])
+
+        self.poller.remove(fast)
+        self.assertEqual(sorted(self.poller.groups), [1000])
+
+    def test_unchanged_reads_are_skipped(self):
+        sensor = self.add(0, convert=lambda x: int(x) / 1000.0)
+        self.poller.poll()
+        self.poller.poll()
+        self.assertEqual(sensor.values, [30.0])
+
+        self.write('temp0_input', '31500\n')
+        self.poller.poll()
+        self.poller.poll()
+        self.assertEqual(sensor.values, [30.0, 31.5])
+        self.assertEqual(
+            sensor.Get(SensorValue.IFACE_NAME, 'value'), 31.5)
+
+    def test_error_set_and_cleared(self):
+        sensor = self.add(0)
+        other = self.add(1)
+        self.poller.poll()
+        self.assertFalse(sensor.error())
+
+        self.write('temp0_input', 'bad\n')
+        self.poller.poll()
+        self.poller.poll()
+        self.assertTrue(sensor.error())
+        self.assertEqual(self.poller.errors, 2)
+        self.assertEqual(sensor.values, [30000])
+
+        self.write('temp0_input', '29000\n')
+        self.write('temp1_input', '29001\n')
+        self.poller.poll()
+        self.assertFalse(sensor.error())
+        self.assertEqual(sensor.values, [30000, 29000])
+        self.assertEqual(other.values, [30001, 29001])
+
+    def test_any_exception_is_confined_to_its_sensor(self):
+        def convert(text):
+            if text == 'none':
+                return None + 1
+            return int(text)
+
+        broken = self.add(0, convert=convert)
+        failing = self.add(1, cls=FailingSensor)
+        sensor = self.add(2)
+        self.write('temp0_input', 'none\n')
+
+        group = self.poller.groups[1000]
+        self.assertTrue(self.poller._poll(group))
+        for tick in range(group.slices - 1):
+            self.poller._poll(group)
+        self.assertTrue(broken.error())
+        self.assertTrue(failing.error())
+        self.assertEqual(sensor.values, [30002])
+
+        ## a sensor whose setValue failed is read and set again
+        self.write('temp0_input', '5\n')
+        self.poller.poll()
+        self.assertFalse(broken.error())
+        self.assertTrue(failing.error())
+        self.assertEqual(self.poller.errors, 3)
+
+
+class FakeClock(object):
+    ''' Stands in for time and for the GLib timers of obmc.sensors,
+    firing the timers as the clock is advanced.
+    '''
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = {}
+        self.next_id = 1
+
+    def time(self):
+        return self.now
+
+    def timeout_add(self, interval, callback, *args):
+        source = self.next_id
+        self.next_id += 1
+        self.timers[source] = (self.now + interval / 1000.0, callback, args)
+        return source
+
+    def source_remove(self, source):
+        del self.timers[source]
+
+    def advance(self, now):
+        while self.timers:
+            source = min(self.timers, key=lambda k: self.timers[k][0])
+            due, callback, args = self.timers[source]
+            if due > now:
+                break
+            del self.timers[source]
+            self.now = due
+            callback(*args)
+        self.now = now
+
+
+class CountingSensor(Sensor):
+    signals = 0
+
+    def PropertiesChanged(self, interface, changed, invalidated):
+        self.signals += 1
+
+
+@unittest.skipUnless(
+    os.environ.get('OBMC_BENCHMARK'), 'set OBMC_BENCHMARK to run')
+class DeadbandBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        obmc.sensors.time = self.clock
+        obmc.sensors.gobject = self.clock
+
+    def tearDown(self):
+        obmc.sensors.time = time
+        obmc.sensors.gobject = gobject
+
+    def test_noisy_trace(self):
+        ## an hour at 10 Hz of a temperature drifting by a few degrees
+        ## with 0.1 degree of noise
+        rng = random.Random(0)
+        trace = [
+            (i / 10.0, 30 + 3 * math.sin(i / 6000.0) +
+             rng.uniform(-0.1, 0.1))
+            for i in range(36000)]
+
+        unfiltered = CountingSensor('/sensors/unfiltered')
+        filtered = CountingSensor('/sensors/filtered')
+        filtered.set_deadband(
+            Deadband(absolute=0.5, min_interval=1, max_interval=30))
+        for now, value in trace:
+            self.clock.advance(now)
+            unfiltered.setValue(value)
+            filtered.setValue(value)
+
+        print '\n%d signals filtered, %d unfiltered (%d samples)' % (
+            filtered.signals, unfiltered.signals, len(trace))
+        self.assertEqual(unfiltered.signals, len(trace))
+        self.assertLess(filtered.signals, len(trace) / 100)
+        self.assertEqual(filtered.getValue(), trace[-1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()